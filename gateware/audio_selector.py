@@ -1,4 +1,6 @@
 
+import math
+
 from amaranth import *
 from amaranth.utils import bits_for
 
@@ -15,7 +17,15 @@ from streams.ops import Enumerate
 
 from gpio import GpioOut, GpioIn
 
-from ppm import StereoAbs, PPM, BarGraph
+from ppm import StereoAbs, TruePeak, MaxDecimate, PPM, LogPPM, LutBarGraph, LevelMeter, Loudness
+from readback import SpiReadback, LinkStats
+from crossfade import Crossfade, ZeroCross
+from latency import Latency
+from decouple import DecoupledTee
+from underrun import Underrun, AlarmLed
+from elastic import Elastic
+from resample import Resample
+from tdm import Packetizer, TdmOutput
 
 audio = 16
 audio_layout = [("data", audio)]
@@ -25,6 +35,14 @@ left_layout = [("left", audio)]
 right_layout = [("right", audio)]
 stereo_layout = left_layout + right_layout
 led_layout = [("addr", 8), ("r", 8), ("g", 8), ("b", 8), ]
+# fs << rate
+sample_rates = [ 48000, 96000, 192000 ]
+
+def justify(name, src, dst):
+    # Stream.connect() fn : the top bits of src, or src left justified
+    if len(src) >= len(dst):
+        return [ dst.eq(src[-len(dst):]) ]
+    return [ dst.eq(Cat(Const(0, len(dst) - len(src)), src)) ]
 
 #
 #
@@ -34,7 +52,18 @@ class TR:
     GPIO = 0
     LED = 1
     SELECT = 2
+    LEVELS = 3
+    LOUDNESS = 4
+    LATENCY = 5
     MONITOR = 6
+    LINKS = 7
+    DROPS = 8
+    UNDERRUN = 9
+    ELASTIC = 10
+    RATE = 11
+    RESAMPLE = 12
+    # one per output bus, after the program
+    BUS = 13
     KEYS = 16
 
 routes = [
@@ -42,6 +71,14 @@ routes = [
     TR.LED,
     #TR.MONITOR,
     #TR.SELECT,
+    TR.LEVELS,
+    TR.LOUDNESS,
+    TR.LATENCY,
+    TR.DROPS,
+    TR.UNDERRUN,
+    TR.ELASTIC,
+    TR.RATE,
+    TR.RESAMPLE,
     TR.KEYS,
 ]
 
@@ -72,6 +109,10 @@ class UI(Elaboratable):
         self.edit = Signal(range(chans))
         self.edit_mode = Signal()
 
+        # inputs with signal present, shown in edit_mode
+        self.live = Signal(chans)
+        self.shown = Signal(chans)
+
         self.leds = leds
         self.led = Signal(range(leds+1))
         self.update = Signal()
@@ -109,10 +150,19 @@ class UI(Elaboratable):
                     m.d.sync += self.o.r.eq(self.bright)
                 with m.If(self.led == self.edit):
                     m.d.sync += self.o.g.eq(self.bright)
+                with m.If(self.led < self.chans):
+                    with m.If(self.shown.bit_select(self.led, 1)):
+                        m.d.sync += self.o.b.eq(self.bright)
 
                 with m.If(self.led == (self.leds-1)):
                     m.d.sync += self.led.eq(0)
 
+        # redraw if the live inputs change while editing
+        with m.If(self.edit_mode & (self.led == 0) & (self.live != self.shown)):
+            m.d.sync += self.update.eq(1)
+        with m.If(self.led == 0):
+            m.d.sync += self.shown.eq(self.live)
+
         with m.If((~self.keys.ready) & (self.led == 0)):
             m.d.sync += self.keys.ready.eq(1)
 
@@ -172,24 +222,52 @@ class UI(Elaboratable):
 
 class Meter(Elaboratable):
 
-    def __init__(self, thresholds=[]):
+    # width : of the input samples, the meter uses the top 16 bits
+    # rates : the input is at 48kHz << rate, the ballistics stay at 48kHz
+    def __init__(self, thresholds=[], log=False, true_peak=False, width=audio, rates=1):
         self.mods = []
         self.connects = []
+        self.rate = Signal(range(rates))
+        self.rated = []
 
         led_width = 8
         bar_len = len(thresholds)
         bar_layout = [("data", led_width)]
-        self.i = Stream(layout=stereo_layout, name="i")
+        self.i = Stream(layout=[("left", width), ("right", width)], name="i")
 
-        self.abs = StereoAbs(layout=stereo_layout)
+        if true_peak:
+            # x4 oversampled, to catch the inter-sample overs
+            self.abs = TruePeak(layout=stereo_layout, rates=rates)
+            self.rated += [ self.abs ]
+        else:
+            self.abs = StereoAbs(layout=stereo_layout)
         self.mods += [ self.abs ]
-        self.connects += [ (self.i, self.abs.i) ]
-
-        self.ppm = PPM(layout=audio_layout)
+        self.connects += [ (self.i, self.abs.i, {"left":justify, "right":justify}) ]
+        peak = self.abs.o
+
+        if rates > 1:
+            self.decimate = MaxDecimate(width=audio, rates=rates)
+            self.mods += [ self.decimate ]
+            self.rated += [ self.decimate ]
+            self.connects += [ (peak, self.decimate.i) ]
+            peak = self.decimate.o
+
+        if log:
+            # log2 domain PPM, so convert the thresholds to match
+            self.ppm = LogPPM(layout=audio_layout)
+            frac = self.ppm.log.frac
+            thresholds = [ int(math.log2(t) * (1 << frac)) for t in thresholds ]
+            width = self.ppm.log.owidth
+            # index the LUT linearly, in 1/16 octave (0.38dB) steps
+            bars = { "log_bits" : (width - frac) + 4 }
+        else:
+            self.ppm = PPM(layout=audio_layout)
+            width = audio
+            bars = { "mant" : 3 }
         self.mods += [ self.ppm ]
-        self.connects += [ (self.abs.o, self.ppm.i) ]
+        self.connects += [ (peak, self.ppm.i) ]
 
-        self.bars = BarGraph(iwidth=audio, owidth=led_width, thresholds=thresholds)
+        self.bars = LutBarGraph(iwidth=width, owidth=led_width, thresholds=thresholds, **bars)
         self.mods += [ self.bars ]
         self.connects += [ (self.ppm.o, self.bars.i) ]
 
@@ -205,8 +283,11 @@ class Meter(Elaboratable):
         m = Module()
         m.submodules += self.mods
 
-        for a, b in self.connects:
-            m.d.comb += Stream.connect(a, b)
+        for a, b, *fn in self.connects:
+            m.d.comb += Stream.connect(a, b, fn=(fn or [{}])[0])
+
+        for mod in self.rated:
+            m.d.comb += mod.rate.eq(self.rate)
 
         return m
 
@@ -215,11 +296,47 @@ class Meter(Elaboratable):
 
 class AudioSelector(Elaboratable):
 
-    def __init__(self, freq):
+    # switch : "crossfade" or "zero_cross"
+    # link_stats : add handshake counters to every Stream link
+    # latency : measure the input to output latency, read on TR.LATENCY
+    # decouple : only SPDIF can stall the audio, the other outputs may drop
+    # width : of the audio path, 16, 20 or 24 bits
+    # fs : the sample rate at reset, 48k, 96k or 192k. Can be changed with TR.RATE
+    # high_rates : build for 96k and 192k as well as 48k
+    # true_peak : x4 oversampled peak for the Meter, else the sample peak
+    # loudness : add the BS.1770 loudness meter on TR.LOUDNESS
+    # spdif_src : convert the SPDIF input from any rate, eg. 44.1k, to the local rate,
+    #   else an elastic buffer for an input at the local rate
+    # tdm : 8 or 16 slots, every input on the wifi I2S output, else the program
+    # buses : output buses, the program and buses-1 I2S outputs selected over SPI.
+    #   Bus 1 takes the monitor output, i2s 1, unless the TDM is on, else the
+    #   next free I2S output. The program is always on the wifi server, i2s 2,
+    #   or the monitor if the TDM is on.
+    def __init__(self, freq, switch="crossfade", link_stats=False, latency=False, decouple=True, width=audio, fs=48000, high_rates=False, true_peak=False, loudness=False, spdif_src=False, tdm=None, buses=1):
+        assert switch in [ "crossfade", "zero_cross" ], switch
+        assert width in [ 16, 20, 24 ], width
+        assert tdm in [ None, 8, 16 ], tdm
+        assert 1 <= buses <= (TR.KEYS - TR.BUS + 1), buses
+        assert fs in sample_rates, fs
+        assert high_rates or (fs == sample_rates[0]), fs
         self.sys_ck = freq
+        self.width = width
+        rates = len(sample_rates) if high_rates else 1
+        # index into sample_rates
+        self.rate = Signal(range(rates))
+        # modules with a 'rate' input
+        self.rated = []
+        meter_width = audio
+        audio_layout = [("data", width)]
+        left_layout = [("left", width)]
+        right_layout = [("right", width)]
+        stereo_layout = left_layout + right_layout
+        top_bits = lambda m, a, b: justify
         self.mods = []
         self.connects = []
         self.comb = []
+        # replies to read requests, sent out on the SPI cipo line
+        self.reports = []
 
         has_ci = True # add to TR items?
 
@@ -236,7 +353,22 @@ class AudioSelector(Elaboratable):
             self.connects += [ (self.spi.o, self.in_arb.i[1]) ]
 
         sink = True
-        self.router = Router(layout=control_layout, addr_field="data", addrs=routes, sink=sink)
+        # routes to blocks that are not built
+        unused = [ TR.ELASTIC if spdif_src else TR.RESAMPLE ]
+        if not high_rates:
+            unused += [ TR.RATE ]
+        if not loudness:
+            unused += [ TR.LOUDNESS ]
+        if not decouple:
+            # the Tee has no drop counters
+            unused += [ TR.DROPS ]
+        if not latency:
+            unused += [ TR.LATENCY ]
+        addrs = [ a for a in routes if not a in unused ]
+        if link_stats:
+            addrs = addrs + [ TR.LINKS ]
+        addrs = addrs + [ TR.BUS + bus for bus in range(buses - 1) ]
+        self.router = Router(layout=control_layout, addr_field="data", addrs=addrs, sink=sink)
         self.mods += [ self.router ]
         if has_ci:
             self.connects += [ (self.in_arb.o, self.router.i) ]
@@ -253,20 +385,30 @@ class AudioSelector(Elaboratable):
             self.mods += [ self.gpio_select ]
             self.connects += [ (self.router.o[TR.SELECT], self.gpio_select.i) ]
 
+        if TR.RATE in addrs:
+            self.gpio_rate = GpioOut(bits_for(rates - 1), reset=sample_rates.index(fs), name="gpio.rate")
+            self.mods += [ self.gpio_rate ]
+            self.connects += [ (self.router.o[TR.RATE], self.gpio_rate.i) ]
+
         led_device = "ws2812" # "yf923"
         self.ws2812 = LedStream(N=8, sys_ck=freq, device=led_device)
         self.mods += [ self.ws2812 ]
 
-        self.led_arb = Arbiter(layout=led_layout, n=2)
+        # SPI, Meter, alarm
+        self.led_arb = Arbiter(layout=led_layout, n=3)
         self.mods += [ self.led_arb ]
         led_src = self.led_arb.o
  
         self.comb += self.ws2812.connect(self.router.o[TR.LED], self.led_arb.i[0])
 
-        self.i2s_rxck = I2STxClock(width=32, owidth=16)
+        self.i2s_rxck = I2STxClock(width=32, owidth=width)
         self.mods += [ self.i2s_rxck ]
 
-        self.i2s_txck = I2STxClock(width=16)
+        # 16 bit slots, or 32 bit slots for wider samples
+        if width == 16:
+            self.i2s_txck = I2STxClock(width=16)
+        else:
+            self.i2s_txck = I2STxClock(width=32, owidth=width)
         self.mods += [ self.i2s_txck ]
 
         adcs = 4
@@ -275,46 +417,127 @@ class AudioSelector(Elaboratable):
         if spdif_in:
             selects += 1
 
-        self.l_select = Select(layout=[("data", audio)], n=selects, wait_last=False, sink=True)
-        self.mods += [ self.l_select ]
-        self.r_select = Select(layout=[("data", audio)], n=selects, wait_last=False, sink=True)
-        self.mods += [ self.r_select ]
+        # Two Select / Join paths, so the Crossfade can mix the old and the
+        # new channel while switching. ZeroCross only needs one.
+        paths = 2 if switch == "crossfade" else 1
+        self.l_selects = []
+        self.r_selects = []
+        self.joins = []
+        for path in range(paths):
+            l_select = Select(layout=audio_layout, n=selects, wait_last=False, sink=True)
+            r_select = Select(layout=audio_layout, n=selects, wait_last=False, sink=True)
+            join = Join(left=left_layout, right=right_layout)
+            self.mods += [ l_select, r_select, join ]
+            self.connects += [ (l_select.o, join.left, [], {"data":"left"}) ]
+            self.connects += [ (r_select.o, join.right, [], {"data":"right"}) ]
+            self.l_selects.append(l_select)
+            self.r_selects.append(r_select)
+            self.joins.append(join)
+
+        # Output buses after the program, each has a Select / Join path and
+        # an I2S output, with the channel set over SPI.
+        self.buses = []
+        for bus in range(1, buses):
+            l_select = Select(layout=audio_layout, n=selects, wait_last=False, sink=True)
+            r_select = Select(layout=audio_layout, n=selects, wait_last=False, sink=True)
+            join = Join(left=left_layout, right=right_layout)
+            gpio = GpioOut(bits_for(selects - 1), name=f"gpio.bus{bus}")
+            i2so = I2SOutput(width=width, tx_clock=self.i2s_txck)
+            self.mods += [ l_select, r_select, join, gpio, i2so ]
+            self.connects += [ (l_select.o, join.left, [], {"data":"left"}) ]
+            self.connects += [ (r_select.o, join.right, [], {"data":"right"}) ]
+            self.connects += [ (join.o, i2so.i) ]
+            self.connects += [ (self.router.o[TR.BUS + bus - 1], gpio.i) ]
+            self.buses.append((l_select, r_select, gpio, i2so))
+
+        def fanout(src, idx, selects, *args):
+            # feed an input to the same Select input of every path and bus
+            if len(selects) == 1:
+                self.connects += [ (src, selects[0].i[idx], *args) ]
+                return
+            if len(selects) > paths:
+                # the buses may drop, but never stall the program or each other.
+                # There is a tee for every input, so no drop counters to read back.
+                # The left and right tees drop on their own, so after a drop on
+                # one side a bus Join can pair left and right samples that are
+                # one apart : a bus is for monitoring, not a phase exact feed.
+                tee = DecoupledTee(layout=audio_layout, n=len(selects), critical=list(range(paths)), counters=False)
+            else:
+                tee = Tee(layout=audio_layout, n=len(selects), wait_all=True)
+            self.mods += [ tee ]
+            self.connects += [ (src, tee.i, *args) ]
+            for path, select in enumerate(selects):
+                self.connects += [ (tee.o[path], select.i[idx]) ]
 
         self.i2si = []
         for i in range(adcs):
             label = f"i2s{i}"
-            s = I2SInputLR(width=audio, rx_clock=self.i2s_rxck)
+            s = I2SInputLR(width=width, rx_clock=self.i2s_rxck)
             self.mods += [ s ]
             setattr(self, label, s)
             self.i2si.append(s)
 
-            self.connects += [ 
-                (s.left, self.l_select.i[i]),
-                (s.right, self.r_select.i[i]),
-            ]
-
-        self.join = Join(left=left_layout, right=right_layout)
-        self.mods += [ self.join ]
-        self.connects += [ (self.l_select.o, self.join.left, [], {"data":"left"}) ]
-        self.connects += [ (self.r_select.o, self.join.right, [], {"data":"right"}) ]
-
-        self.tee = Tee(layout=stereo_layout, n=3, wait_all=True)
+            fanout(s.left, i, self.l_selects + [ b[0] for b in self.buses ])
+            fanout(s.right, i, self.r_selects + [ b[1] for b in self.buses ])
+
+        # 'switch' has the select input, and the channel on air
+        if switch == "crossfade":
+            ramp_ms = 10
+            self.switch = Crossfade(layout=stereo_layout, chans=selects, ramp=int(48000 * ramp_ms / 1000), period=int(freq / 48000), rates=rates)
+            self.mods += [ self.switch ]
+            self.rated += [ self.switch ]
+            for path, join in enumerate(self.joins):
+                self.connects += [ (join.o, self.switch.i[path]) ]
+            self.program = self.switch.o
+        else:
+            timeout_ms = 20
+            self.switch = ZeroCross(chans=selects, width=meter_width, timeout=int(freq * timeout_ms / 1000))
+            self.mods += [ self.switch ]
+            self.program = self.joins[0].o
+
+        # outputs : SPDIF, I2S, Meter, Loudness
+        outputs = 4 if loudness else 3
+        if decouple:
+            self.tee = DecoupledTee(layout=stereo_layout, n=outputs, critical=[0])
+            self.reports += [ self.tee.ro ]
+            if TR.DROPS in routes:
+                self.connects += [ (self.router.o[TR.DROPS], self.tee.ci) ]
+        else:
+            self.tee = Tee(layout=stereo_layout, n=outputs, wait_all=True)
         self.mods += [ self.tee ]
-        self.connects += [ (self.join.o, self.tee.i), ]
+        self.connects += [ (self.program, self.tee.i), ]
 
-        self.spdif = SPDIF_Tx(iwidth=audio)
+        self.spdif = SPDIF_Tx(iwidth=width)
         self.mods += [ self.spdif ]
         self.connects += [ (self.tee.o[0], self.spdif.i), ]
         self.spdif_o = Signal()
 
-        self.i2so = I2SOutput(width=16, tx_clock=self.i2s_txck)
+        self.i2so = I2SOutput(width=width, tx_clock=self.i2s_txck)
         self.mods += [ self.i2so ]
         self.connects += [ (self.tee.o[1], self.i2so.i), ]
 
+        # Underruns of the SPDIF and I2S outputs
+        self.underrun = Underrun(n=2, period=int(freq / 48000), rates=rates)
+        self.mods += [ self.underrun ]
+        self.rated += [ self.underrun ]
+        self.reports += [ self.underrun.o ]
+        if TR.UNDERRUN in routes:
+            self.connects += [ (self.router.o[TR.UNDERRUN], self.underrun.ci) ]
+
         thresholds = [ 0x10, 0x80, 0x200, 0x800, 0x1000, 0x2000, 0x4000, 0x7fff  ]
-        self.meter = Meter(thresholds=thresholds)
+        self.meter = Meter(thresholds=thresholds, true_peak=true_peak, width=width, rates=rates)
         self.mods += [ self.meter ]
+        self.rated += [ self.meter ]
         self.connects += [ (self.tee.o[2], self.meter.i) ]
+
+        if loudness:
+            # Loudness of the selected channel
+            self.loudness = Loudness(layout=[("left", meter_width), ("right", meter_width)], rates=rates)
+            self.mods += [ self.loudness ]
+            self.rated += [ self.loudness ]
+            self.connects += [ (self.tee.o[3], self.loudness.i, [], {}, {"left":top_bits, "right":top_bits}) ]
+            self.reports += [ self.loudness.o ]
+            self.connects += [ (self.router.o[TR.LOUDNESS], self.loudness.ci) ]
         def dim(m, si, so):
             def _dim(name, src, dst):
                 with m.If(si.addr >= 4):
@@ -333,6 +556,14 @@ class AudioSelector(Elaboratable):
             (self.meter.o, self.led_arb.i[1], ["g","b"], {"data":"g"}, {"data":dim}),
         ]
 
+        # the LED past the meter shows blue after an output underrun, or a
+        # TDM error, sent when it changes so it doesn't need meter packets
+        self.tdm_error = Signal()
+        self.alarm_led = AlarmLed(addr=len(thresholds) - 1)
+        self.mods += [ self.alarm_led ]
+        self.comb += [ self.alarm_led.alarm.eq(self.underrun.alarm | self.tdm_error) ]
+        self.connects += [ (self.alarm_led.o, self.led_arb.i[2]) ]
+
         if TR.KEYS in routes:
             self.gpio_ui = GpioIn(3, name="gpio.ui")
             self.mods += [ self.gpio_ui ]
@@ -363,25 +594,85 @@ class AudioSelector(Elaboratable):
             self.rx_split = Split(layout=layout_20)
             self.mods += [ self.rx_split ]
 
-            def truncate(m, a, b):
-                def to16(name, src, dst):
-                    assert name in [ "left", "right" ], name
-                    return [ dst.eq(src[4:]) ]
-                return to16
-
-            self.connects += [ 
-                (self.rx.audio, self.rx_split.i, ["good"]),
-                (self.rx_split.left, self.l_select.i[selects-1], [], {"left":"data"}, {"left":truncate}),
-                (self.rx_split.right, self.r_select.i[selects-1], [], {"right":"data"}, {"right":truncate}),
-            ]
+            # 20 bit SPDIF data to the width of the audio path
+            truncate = top_bits
+
+            # rate match the SPDIF input to the local clock
+            if spdif_src:
+                # any input rate, eg. 44.1kHz
+                self.rx_match = Resample(layout=layout_20, period=int(freq / 48000), rates=rates)
+                addr = TR.RESAMPLE
+            else:
+                # the same nominal rate, absorbs the drift
+                self.rx_match = Elastic(layout=layout_20, period=int(freq / 48000), rates=rates)
+                addr = TR.ELASTIC
+            self.mods += [ self.rx_match ]
+            self.rated += [ self.rx_match ]
+            self.reports += [ self.rx_match.ro ]
+            if addr in addrs:
+                self.connects += [ (self.router.o[addr], self.rx_match.ci) ]
+
+            self.connects += [ (self.rx.audio, self.rx_match.i, ["good"]) ]
+            self.connects += [ (self.rx_match.o, self.rx_split.i) ]
+            fanout(self.rx_split.left, selects-1, self.l_selects + [ b[0] for b in self.buses ], [], {"left":"data"}, {"left":truncate})
+            fanout(self.rx_split.right, selects-1, self.r_selects + [ b[1] for b in self.buses ], [], {"right":"data"}, {"right":truncate})
 
             self.spdif_i = Signal()
 
+        if tdm:
+            # every input, tapped before the Select, one frame per Fs
+            chans = min(tdm, 2 * selects)
+            self.packetizer = Packetizer(n=chans, width=width)
+            self.mods += [ self.packetizer ]
+            self.tdm = TdmOutput(slots=tdm, width=32, iwidth=width)
+            self.mods += [ self.tdm ]
+            self.connects += [ (self.packetizer.o, self.tdm.i) ]
+
+            # 'en' runs at Fs * 2 * 32 * slots, at most once per clock : the
+            # counter mask for each rate, or None if the rate is too high
+            self.tdm_masks = []
+            for rate_fs in sample_rates[:rates]:
+                div = int(freq // (rate_fs * 2 * 32 * tdm))
+                self.tdm_masks.append(((1 << (bits_for(div) - 1)) - 1) if div else None)
+            assert self.tdm_masks[sample_rates.index(fs)] is not None, f"TDM{tdm} at {fs} needs sys_ck >= {fs * 64 * tdm}"
+
+        # Peak levels of every input, tapped before the Select
+        self.levels = LevelMeter(n=2*selects, width=meter_width, sys_ck=freq)
+        self.mods += [ self.levels ]
+        self.reports += [ self.levels.o ]
+        if TR.LEVELS in routes:
+            self.connects += [ (self.router.o[TR.LEVELS], self.levels.ci) ]
+
+        if latency:
+            # Latency from the selected input to the SPDIF and I2S outputs
+            timeout = int(8 * freq / 48000)
+            self.latency = Latency(chans=selects, outputs=2, width=meter_width, timeout=timeout)
+            self.mods += [ self.latency ]
+            self.reports += [ self.latency.o ]
+            self.connects += [ (self.router.o[TR.LATENCY], self.latency.ci) ]
+
         if TR.MONITOR in routes:
             self.monitor = Monitor(layout=audio_layout, n=8)
             self.mods += [ self.monitor ]
             self.connects += [ (self.router.o[TR.MONITOR], self.monitor.ci) ]
 
+        if link_stats:
+            self.link_stats = LinkStats(self.connects)
+            self.mods += [ self.link_stats ]
+            self.reports += [ self.link_stats.o ]
+            self.connects += [ (self.router.o[TR.LINKS], self.link_stats.ci) ]
+
+        self.readback = SpiReadback(width=control)
+        self.mods += [ self.readback ]
+        if len(self.reports) == 1:
+            self.connects += [ (self.reports[0], self.readback.i) ]
+        else:
+            self.report_arb = Arbiter(layout=control_layout, n=len(self.reports))
+            self.mods += [ self.report_arb ]
+            for i, s in enumerate(self.reports):
+                self.connects += [ (s, self.report_arb.i[i]) ]
+            self.connects += [ (self.report_arb.o, self.readback.i) ]
+
     def elaborate(self, platform):
         m = Module()
         m.submodules += self.mods
@@ -403,10 +694,78 @@ class AudioSelector(Elaboratable):
             m.d.comb += eq
         self.comb = []
 
+        # The sample rate
+        if hasattr(self, "gpio_rate"):
+            last = len(sample_rates) - 1
+            m.d.comb += self.rate.eq(Mux(self.gpio_rate.o > last, last, self.gpio_rate.o))
+        for mod in self.rated:
+            m.d.comb += mod.rate.eq(self.rate)
+
         # The channel selection
+        m.d.comb += self.switch.select.eq(self.ui.channel)
+        if isinstance(self.switch, Crossfade):
+            for path in range(2):
+                m.d.comb += [
+                    self.l_selects[path].select.eq(self.switch.path_select[path]),
+                    self.r_selects[path].select.eq(self.switch.path_select[path]),
+                ]
+        else:
+            m.d.comb += [
+                self.l_selects[0].select.eq(self.switch.channel),
+                self.r_selects[0].select.eq(self.switch.channel),
+                self.switch.frame.eq(self.program.valid & self.program.ready),
+            ]
+        # a bus select past the last input holds the last one
+        last = len(self.l_selects[0].i) - 1
+        for l_select, r_select, gpio, _ in self.buses:
+            select = Mux(gpio.o > last, last, gpio.o)
+            m.d.comb += [
+                l_select.select.eq(select),
+                r_select.select.eq(select),
+            ]
+
+        # Tap the inputs to the Select
+        inputs = []
+        for s in self.i2si:
+            inputs += [ (s.left, s.left.data), (s.right, s.right.data) ]
+        if hasattr(self, "rx"):
+            # the 20-bit SPDIF data
+            inputs += [
+                (self.rx_split.left, self.rx_split.left.left),
+                (self.rx_split.right, self.rx_split.right.right),
+            ]
+        if hasattr(self, "tdm"):
+            m.d.comb += self.packetizer.start.eq(self.tdm.frame)
+            for idx, (s, data) in enumerate(inputs[:self.packetizer.n]):
+                # left justified to the width of the audio path
+                if len(data) < self.width:
+                    data = Cat(Const(0, self.width - len(data)), data)
+                m.d.comb += self.packetizer.tap(idx, s, data[-self.width:])
+
+        # the level meters use the top 16 bits
+        taps = [ (s, data[-16:]) for s, data in inputs ]
+        for idx, (s, data) in enumerate(taps):
+            m.d.comb += self.levels.tap(idx, s, data)
+            if isinstance(self.switch, ZeroCross):
+                m.d.comb += self.switch.tap(idx, s, data)
+            if hasattr(self, "latency") and ((idx % 2) == 0):
+                m.d.comb += self.latency.tap_in(idx // 2, s, data)
+        if hasattr(self, "latency"):
+            m.d.comb += [
+                self.latency.channel.eq(self.switch.channel),
+                self.latency.tap_out(0, self.spdif.i, self.spdif.i.left[-16:]),
+                self.latency.tap_out(1, self.i2so.i, self.i2so.i.left[-16:]),
+            ]
         m.d.comb += [
-            self.l_select.select.eq(self.ui.channel),
-            self.r_select.select.eq(self.ui.channel),
+            self.underrun.tap(0, self.spdif.i),
+            self.underrun.tap(1, self.i2so.i),
+        ]
+        live = self.levels.live
+        m.d.comb += self.ui.live.eq(Cat([ live[2*i] | live[2*i+1] for i in range(len(self.l_selects[0].i)) ]))
+
+        m.d.comb += [
+            self.readback.scs.eq(self.spi.phy.scs),
+            self.readback.sck.eq(self.spi.phy.sck),
         ]
 
         if hasattr(self, "monitor"):
@@ -416,13 +775,13 @@ class AudioSelector(Elaboratable):
                 ("router.i", self.router.i, {}),
                 #("gpio.led.i", self.gpio_led.i, {}),
                 ("i2si[0].o", self.i2si[0].left, {}),
-                ("l_select.i[0]", self.l_select.i[0], {}),
-                #("l_select.i[1]", self.l_select.i[1], {}),
-                #("l_select.i[2]", self.l_select.i[2], {}),
-                #("l_select.i[3]", self.l_select.i[3], {}),
-                ("l_select.o", self.l_select.o, {}),
+                ("l_select.i[0]", self.l_selects[0].i[0], {}),
+                #("l_select.i[1]", self.l_selects[0].i[1], {}),
+                #("l_select.i[2]", self.l_selects[0].i[2], {}),
+                #("l_select.i[3]", self.l_selects[0].i[3], {}),
+                ("l_select.o", self.l_selects[0].o, {}),
                 ("i2so.i", self.i2so.i, {"data":"left"}),
-                #("join.o", self.join.o, {"data":"left"}),
+                #("program", self.program, {"data":"left"}),
                 #("meter.o", self.meter.o, {}),
             ]
 
@@ -434,21 +793,32 @@ class AudioSelector(Elaboratable):
         clock_bits = bits_for(int(self.sys_ck / debounce_freq))
         counter = Signal(clock_bits)
         m.d.sync += counter.eq(counter + 1)
-        # External Xtal is Fs * 1024
+        # External Xtal is 48kHz * 1024, Fs is 48kHz << rate
         self.fs_128 = Signal()
         self.fs_64  = Signal()
-        m.d.comb += self.fs_128.eq((counter & 0x07) == 0)
-        m.d.comb += self.fs_64.eq ((counter & 0x0f) == 0)
+        m.d.comb += self.fs_128.eq((counter & (Const(0x07, 3) >> self.rate)) == 0)
+        m.d.comb += self.fs_64.eq ((counter & (Const(0x0f, 4) >> self.rate)) == 0)
 
-        # Fs * 512 for the MCK I2S input master ref
+        # 48kHz * 512 for the MCK I2S input master ref, Fs * 128 at 192kHz
         self.mck = Signal()
         m.d.comb += self.mck.eq(counter) # square wave : sys_ck/2
         # Fs * 128 for the SPDIF 2*clock signal
         m.d.comb += self.spdif.en.eq(self.fs_128)
         # Fs * 128 for the I2S input 2*clock signal
         m.d.comb += self.i2s_rxck.enable.eq(self.fs_128)
-        # Fs * 64 for the I2S output 2*clock signal
-        m.d.comb += self.i2s_txck.enable.eq(self.fs_64)
+        # Fs * 64 for the I2S output 2*clock signal, Fs * 128 for 32 bit slots
+        if self.width == 16:
+            m.d.comb += self.i2s_txck.enable.eq(self.fs_64)
+        else:
+            m.d.comb += self.i2s_txck.enable.eq(self.fs_128)
+        if hasattr(self, "tdm"):
+            # Fs * 2 * 32 * slots : off, with an error, if over sys_ck
+            for rate, mask in enumerate(self.tdm_masks):
+                with m.If(self.rate == rate):
+                    if mask is None:
+                        m.d.comb += self.tdm_error.eq(1)
+                    else:
+                        m.d.comb += self.tdm.en.eq((counter & mask) == 0)
 
         # debounce (sample) clock for the UI buttons
         self.debounce = Signal()
@@ -457,8 +827,12 @@ class AudioSelector(Elaboratable):
 
         # connect the SPDIF io to spdif_i/o
         if hasattr(self, "rx"):
-            idx = len(self.l_select.i) - 1
-            with m.If(self.ui.channel == idx):
+            idx = len(self.l_selects[0].i) - 1
+            on_air = self.switch.channel == idx
+            if isinstance(self.switch, Crossfade):
+                # only once the crossfade to it is complete
+                on_air &= ~self.switch.fading
+            with m.If(on_air):
                 # loop spdif input to the output
                 m.d.comb += [ self.spdif_o.eq(self.spdif_i) ]
             with m.Else():
@@ -502,6 +876,7 @@ class _System(AudioSelector):
             self.spi.phy.scs.eq(from_i(spi.cs)),
             self.spi.phy.sck.eq(from_i(spi.sck)),
             self.spi.phy.copi.eq(from_i(spi.copi)),
+            to_o(spi.cipo).eq(self.readback.cipo),
         ]
 
         spdif = platform.request("spdif", 0)
@@ -510,27 +885,35 @@ class _System(AudioSelector):
             to_o(spdif.tx).eq(self.spdif_o),
         ]
 
-        # I2S output monitor
-        try:
-            i2s = platform.request("i2s", 1)
-            comb += [
-                to_o(i2s.sck).eq(self.i2so.phy.sck),
-                to_o(i2s.ws).eq(self.i2so.phy.ws),
-                to_o(i2s.sd).eq(self.i2so.phy.sd),
-            ]
-        except Exception as ex:
-            print(ex)
-
-        # I2S output wifi server
-        try:
-            i2s = platform.request("i2s", 2)
-            comb += [
-                to_o(i2s.sck).eq(self.i2so.phy.sck),
-                to_o(i2s.ws).eq(self.i2so.phy.ws),
-                to_o(i2s.sd).eq(self.i2so.phy.sd),
-            ]
-        except Exception as ex:
-            print(ex)
+        # I2S outputs : the program is always on a pin, the wifi server
+        # (i2s 2), or the monitor (i2s 1) if the wifi server has the TDM.
+        # Each bus takes the next free output, i2s 1 then i2s 3, 4 ... and
+        # the monitor has the program if no bus takes it.
+        pins = {}
+        if hasattr(self, "tdm"):
+            # every input, TDM
+            pins[2] = self.tdm
+            pins[1] = self.i2so.phy
+        else:
+            pins[2] = self.i2so.phy
+        idx = 1
+        for _, _, _, i2so in self.buses:
+            while idx in pins:
+                idx += 1
+            pins[idx] = i2so.phy
+        if not 1 in pins:
+            pins[1] = self.i2so.phy
+
+        for idx, out in sorted(pins.items()):
+            try:
+                i2s = platform.request("i2s", idx)
+                comb += [
+                    to_o(i2s.sck).eq(out.sck),
+                    to_o(i2s.ws).eq(out.ws),
+                    to_o(i2s.sd).eq(out.sd),
+                ]
+            except Exception as ex:
+                print(ex)
 
         # I2S input block from ADCs
         try:
@@ -567,7 +950,7 @@ class _System(AudioSelector):
             s = self.monitor.o0
             sd = self.monitor.o0.data
         else:
-            s = self.join.o
+            s = self.program
             sd = s.left
 
         try:
@@ -653,7 +1036,7 @@ class System(_System):
         if hasattr(self, "gpio_led"):
             m.d.comb += leds.eq(Cat(self.gpio_led.o))
         else:
-            m.d.comb += leds.eq(1 << self.l_select.select)
+            m.d.comb += leds.eq(1 << self.switch.channel)
 
         return m
 
@@ -0,0 +1,245 @@
+
+from amaranth import *
+from amaranth.utils import bits_for
+
+from streams import Stream
+
+from tap import Taps
+
+#
+#   Crossfade between two paths when the channel changes.
+#
+#   Each input 'i[n]' is fed by its own Select, driven by 'path_select[n]'.
+#   One path is on air. When 'select' changes, the other path is switched to
+#   the new channel and the output ramps linearly from the old path to the
+#   new one over 'ramp' samples ('ramp << rate' at the higher sample rates).
+#   The new path is then on air, and the old one is released.
+#
+#   Both inputs are always consumed. Outside a fade, samples on the other
+#   path are dropped, so a dead input can't stall the output. During a fade
+#   a sample is taken from each path and mixed, one field at a time, through
+#   one multiplier : out = old + ((new - old) * gain). If one path has a
+#   sample and the other has none for half of 'period' clocks (the sample
+#   period at 48kHz), the missing sample is taken as silence, so a fade to
+#   or from a dead input still runs.
+#
+#   A change of 'select' during a fade aborts it : the old path is on air
+#   again, and a new fade starts if 'select' is not the old channel.
+
+class Crossfade(Elaboratable):
+
+    def __init__(self, layout, chans, ramp, period, gbits=16, rates=1, name="Crossfade"):
+        assert ramp > 0
+        self.name = name
+        self.fields = [ name for name, _ in layout ]
+        width = layout[0][1]
+        self.width = width
+        self.i = [ Stream(layout=layout, name=f"i{n}") for n in range(2) ]
+        self.o = Stream(layout=layout, name="o")
+
+        self.select = Signal(range(chans))
+        self.path_select = [ Signal(range(chans), name=f"path_select{n}") for n in range(2) ]
+        # the channel on air, only changed at the end of a fade
+        self.channel = Signal(range(chans))
+        self.fading = Signal()
+        # path on air
+        self.path = Signal()
+
+        self.gbits = gbits
+        self.step = -(-(1 << gbits) // ramp)
+        self.gain = Signal(gbits + 1)
+        self.rate = Signal(range(rates))
+
+        # clocks waiting for a sample on the other path
+        self.timeout = period // 2
+        self.wait = Signal(range(self.timeout + 1))
+
+        n = len(self.fields)
+        self.old = Array([ Signal(signed(width), name=f"old_{f}") for f in self.fields ])
+        self.new = Array([ Signal(signed(width), name=f"new_{f}") for f in self.fields ])
+        self.field = Signal(range(n))
+        self.prod = Signal(signed(width + gbits + 3))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        old = Array(self.i)[self.path]
+        new = Array(self.i)[~self.path]
+
+        def latch(dst, s):
+            # silence if the path has no sample
+            return [ d.eq(Mux(s.valid, getattr(s, f), 0)) for d, f in zip(dst, self.fields) ]
+
+        def output(src):
+            return [ getattr(self.o, f).eq(v) for f, v in zip(self.fields, src) ]
+
+        # start a fade when the channel changes
+        with m.If((~self.fading) & (self.select != self.channel)):
+            m.d.sync += [
+                Array(self.path_select)[~self.path].eq(self.select),
+                self.gain.eq(0),
+                self.fading.eq(1),
+            ]
+        # abort a fade when the channel changes again
+        with m.If(self.fading & (self.select != Array(self.path_select)[~self.path])):
+            m.d.sync += self.fading.eq(0)
+
+        last = len(self.fields) - 1
+        step = Signal.like(self.gain)
+        m.d.comb += step.eq(self.step >> self.rate)
+        timeout = Signal.like(self.wait)
+        m.d.comb += timeout.eq(self.timeout >> self.rate)
+        mixed = Signal(signed(self.width + 1))
+        m.d.comb += mixed.eq(self.old[self.field] + (self.prod >> self.gbits))
+
+        with m.FSM(reset="IDLE"):
+
+            with m.State("IDLE"):
+                with m.If(~self.fading):
+                    m.d.comb += [
+                        old.ready.eq(1),
+                        new.ready.eq(1),
+                    ]
+                    m.d.sync += self.wait.eq(0)
+                    with m.If(old.valid):
+                        m.d.sync += output([ getattr(old, f) for f in self.fields ])
+                        m.next = "OUT"
+                with m.Else():
+                    both = old.valid & new.valid
+                    either = old.valid | new.valid
+                    with m.If(both | (either & (self.wait >= timeout))):
+                        m.d.comb += [
+                            old.ready.eq(old.valid),
+                            new.ready.eq(new.valid),
+                        ]
+                        m.d.sync += latch(self.old, old) + latch(self.new, new)
+                        m.d.sync += [
+                            self.field.eq(0),
+                            self.wait.eq(0),
+                        ]
+                        m.next = "MUL"
+                    with m.Elif(either):
+                        m.d.sync += self.wait.eq(self.wait + 1)
+
+            with m.State("MUL"):
+                m.d.sync += self.prod.eq((self.new[self.field] - self.old[self.field]) * self.gain)
+                m.next = "ADD"
+
+            with m.State("ADD"):
+                with m.Switch(self.field):
+                    for idx, f in enumerate(self.fields):
+                        with m.Case(idx):
+                            m.d.sync += getattr(self.o, f).eq(mixed)
+                m.d.sync += self.field.eq(self.field + 1)
+                with m.If(self.field == last):
+                    m.next = "OUT"
+                with m.Else():
+                    m.next = "MUL"
+
+            with m.State("OUT"):
+                m.d.sync += self.o.valid.eq(1)
+                with m.If(self.fading):
+                    m.d.sync += self.gain.eq(self.gain + step)
+                    with m.If((self.gain + step) >= (1 << self.gbits)):
+                        # the next sample is all new : release the old path
+                        m.d.sync += [
+                            self.fading.eq(0),
+                            self.path.eq(~self.path),
+                            self.channel.eq(Array(self.path_select)[~self.path]),
+                        ]
+                m.next = "WAIT"
+
+            with m.State("WAIT"):
+                with m.If(self.o.valid & self.o.ready):
+                    m.d.sync += self.o.valid.eq(0)
+                    m.next = "IDLE"
+
+        return m
+
+#
+#   Switch channels at a zero crossing.
+#
+#   A cheaper alternative to the Crossfade, using a single Select / Join
+#   path. A change of 'select' is held until the left and right inputs of
+#   both the old and the new channel have crossed zero, or until 'timeout'
+#   clocks. 'channel' is then changed on a frame boundary, the clock when
+#   'frame' (the Join output transfer) is set, so the Join always pairs a
+#   left and a right sample. If the old channel is dead there are no
+#   frames : after the timeout, if there has been no frame for 'timeout'
+#   clocks, 'channel' is changed anyway. A change of 'select' while a
+#   switch is held cancels it.
+#
+#   tap() watches a Select input : input 2n is the left, 2n+1 the right of
+#   channel n.
+
+class ZeroCross(Elaboratable):
+
+    def __init__(self, chans, width, timeout, name="ZeroCross"):
+        self.name = name
+        self.n = 2 * chans
+        self.timeout = timeout
+
+        self.taps = Taps(self.n, signed(width))
+        self.strobe = self.taps.strobe
+        self.sample = self.taps.sample
+        self.tap = self.taps.tap
+        self.sign = Signal(self.n)
+        self.crossed = Signal(self.n)
+
+        self.select = Signal(range(chans))
+        self.channel = Signal(range(chans))
+        self.target = Signal(range(chans))
+        self.frame = Signal()
+        self.pending = Signal()
+        self.timer = Signal(range(timeout + 1))
+        # clocks since the last frame
+        self.idle = Signal(range(timeout + 1))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # left and right have both crossed zero
+        old = Signal()
+        new = Signal()
+        m.d.comb += [
+            old.eq(self.crossed.bit_select(2*self.channel, 2).all()),
+            new.eq(self.crossed.bit_select(2*self.target, 2).all()),
+        ]
+
+        with m.If(~self.pending):
+            with m.If(self.select != self.channel):
+                m.d.sync += [
+                    self.pending.eq(1),
+                    self.target.eq(self.select),
+                    self.crossed.eq(0),
+                    self.timer.eq(0),
+                ]
+        with m.Elif(self.select != self.target):
+            # cancel, start again next clock if need be
+            m.d.sync += self.pending.eq(0)
+        with m.Else():
+            with m.If(self.timer != self.timeout):
+                m.d.sync += self.timer.eq(self.timer + 1)
+            late = self.timer == self.timeout
+            with m.If((self.frame & ((old & new) | late)) | (late & (self.idle == self.timeout))):
+                m.d.sync += [
+                    self.pending.eq(0),
+                    self.channel.eq(self.target),
+                ]
+
+        with m.If(self.frame):
+            m.d.sync += self.idle.eq(0)
+        with m.Elif(self.idle != self.timeout):
+            m.d.sync += self.idle.eq(self.idle + 1)
+
+        # sign tracking : after the clear, so a new sample wins
+        for i in range(self.n):
+            with m.If(self.strobe[i]):
+                neg = self.sample[i] < 0
+                m.d.sync += self.sign[i].eq(neg)
+                with m.If((neg != self.sign[i]) | (self.sample[i] == 0)):
+                    m.d.sync += self.crossed[i].eq(1)
+
+        return m
+
+#   FIN
@@ -0,0 +1,90 @@
+
+from amaranth import *
+from amaranth.lib.fifo import SyncFIFO
+
+from streams import Stream
+
+from readback import Registers
+
+#
+#   Tee where only the 'critical' outputs can stall the input.
+#
+#   The input is taken once every critical output has taken it. Each of the
+#   other outputs has a FIFO of 'depth' samples : if the FIFO is full when
+#   the input is taken, the sample is dropped for that output and counted in
+#   'drops'. A packet on 'ci' requests the drop counts, one word per output,
+#   sent as a packet on 'ro'. Critical outputs read 0. With counters=False
+#   the drops are not counted, and there is no 'ci' / 'ro'.
+
+class DecoupledTee(Elaboratable):
+
+    def __init__(self, layout, n, critical=[0], depth=4, width=32, counters=True, name="DecoupledTee"):
+        assert critical
+        self.name = name
+        self.layout = layout
+        self.critical = critical
+        self.i = Stream(layout=layout, name="i")
+        self.o = [ Stream(layout=layout, name=f"o{k}") for k in range(n) ]
+
+        payload = sum([ w for _, w in layout ]) + 2 # first, last
+        self.fifos = {}
+        for k in range(n):
+            if not k in critical:
+                self.fifos[k] = SyncFIFO(width=payload, depth=depth)
+
+        # critical outputs that have already taken the input
+        self.done = Signal(n)
+        self.mods = list(self.fifos.values())
+
+        self.counters = counters
+        if counters:
+            self.drops = [ Signal(width, name=f"drops{k}") for k in range(n) ]
+
+            self.regs = Registers(self.drops, width=width, name=f"{name}.regs")
+            self.ci = self.regs.i
+            self.ro = self.regs.o
+            self.mods += [ self.regs ]
+
+    def pack(self, s):
+        return Cat(*[ getattr(s, name) for name, _ in self.layout ], s.first, s.last)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mods
+
+        accept = Signal()
+        m.d.comb += [
+            self.i.ready.eq(Cat([ self.o[k].ready | self.done[k] for k in self.critical ]).all()),
+            accept.eq(self.i.valid & self.i.ready),
+        ]
+
+        with m.If(accept):
+            m.d.sync += self.done.eq(0)
+
+        for k, o in enumerate(self.o):
+            if k in self.critical:
+                m.d.comb += [
+                    o.valid.eq(self.i.valid & ~self.done[k]),
+                    o.first.eq(self.i.first),
+                    o.last.eq(self.i.last),
+                ]
+                m.d.comb += [ getattr(o, name).eq(getattr(self.i, name)) for name, _ in self.layout ]
+                with m.If(o.valid & o.ready & ~accept):
+                    m.d.sync += self.done[k].eq(1)
+                continue
+
+            fifo = self.fifos[k]
+            m.d.comb += [
+                fifo.w_data.eq(self.pack(self.i)),
+                fifo.w_en.eq(accept & fifo.w_rdy),
+                o.valid.eq(fifo.r_rdy),
+                self.pack(o).eq(fifo.r_data),
+                fifo.r_en.eq(o.ready),
+            ]
+            if self.counters:
+                with m.If(accept & ~fifo.w_rdy):
+                    m.d.sync += self.drops[k].eq(self.drops[k] + 1)
+
+        return m
+
+#   FIN
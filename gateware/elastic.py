@@ -0,0 +1,170 @@
+
+from amaranth import *
+from amaranth.lib.fifo import SyncFIFO
+
+from streams import Stream
+
+from readback import Registers
+
+#
+#   Elastic buffer for a stream on a remote clock, eg. the SPDIF input.
+#
+#   Samples are written to a FIFO as they arrive, and read out at the local
+#   rate, one every 'period >> rate' clocks. The FIFO is kept around half full : if
+#   it is filling up a sample is dropped, if it is emptying a sample is
+#   repeated. Both are done at a zero crossing of the first field, unless
+#   the FIFO is empty (repeat) or full (the new sample is lost).
+#
+#   The input samples are counted over a window of 2^window_bits local
+#   periods : 'delta' is the count less the window, so the remote clock is
+#   delta * 1e6 / 2^window_bits ppm fast. See ppm().
+#
+#   A packet on 'ci' requests the stats, sent as a packet on 'o' :
+#   delta, fill level, drops, repeats, overflows.
+
+class Elastic(Elaboratable):
+
+    def __init__(self, layout, period, rates=1, depth=16, window_bits=20, width=32, name="Elastic"):
+        self.name = name
+        self.layout = layout
+        self.period = period
+        self.depth = depth
+        self.window_bits = window_bits
+        self.low = depth // 4
+        self.high = depth - self.low
+
+        self.i = Stream(layout=layout, name="i")
+        self.o = Stream(layout=layout, name="o")
+
+        payload = sum([ w for _, w in layout ])
+        self.fifo = SyncFIFO(width=payload, depth=depth)
+
+        self.rate = Signal(range(rates))
+        self.timer = Signal(range(period))
+        self.tick = Signal()
+        self.primed = Signal()
+
+        # drift measurement
+        self.window = Signal(window_bits)
+        self.count = Signal(window_bits + 2)
+        self.delta = Signal(signed(width))
+
+        self.fill = Signal(width)
+        self.drops = Signal(width)
+        self.repeats = Signal(width)
+        self.overflows = Signal(width)
+
+        self.regs = Registers([ self.delta, self.fill, self.drops, self.repeats, self.overflows ], width=width, name=f"{name}.regs")
+        self.ci = self.regs.i
+        self.ro = self.regs.o
+
+        self.mods = [
+            self.fifo,
+            self.regs,
+        ]
+
+    def ppm(self, delta):
+        # convert a 'delta' reading to ppm
+        if delta & (1 << 31):
+            delta -= 1 << 32
+        return delta * 1e6 / (1 << self.window_bits)
+
+    def unpack(self, data):
+        fields = []
+        lsb = 0
+        for _, w in self.layout:
+            fields.append(data[lsb:lsb+w])
+            lsb += w
+        return fields
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mods
+
+        fields = [ getattr(self.o, name) for name, _ in self.layout ]
+        head = Signal(len(self.fifo.r_data))
+        m.d.comb += head.eq(self.fifo.r_data)
+
+        # input : never stalls the remote source
+        m.d.comb += [
+            self.i.ready.eq(1),
+            self.fifo.w_data.eq(Cat(*[ getattr(self.i, name) for name, _ in self.layout ])),
+            self.fifo.w_en.eq(self.i.valid),
+        ]
+        with m.If(self.i.valid & ~self.fifo.w_rdy):
+            m.d.sync += self.overflows.eq(self.overflows + 1)
+
+        # local rate
+        m.d.sync += self.timer.eq(self.timer + 1)
+        with m.If(self.timer == ((self.period >> self.rate) - 1)):
+            m.d.sync += self.timer.eq(0)
+        m.d.comb += self.tick.eq(self.timer == 0)
+
+        # drift
+        with m.If(self.i.valid):
+            m.d.sync += self.count.eq(self.count + 1)
+        with m.If(self.tick):
+            m.d.sync += self.window.eq(self.window + 1)
+            with m.If(self.window == ((1 << self.window_bits) - 1)):
+                m.d.sync += [
+                    self.delta.eq(self.count + self.i.valid - (1 << self.window_bits)),
+                    self.count.eq(0),
+                ]
+
+        level = self.fifo.r_level
+        m.d.sync += self.fill.eq(level)
+
+        with m.If(level >= (self.depth // 2)):
+            m.d.sync += self.primed.eq(1)
+
+        # zero crossing of the first field
+        msb = self.layout[0][1] - 1
+        data = self.unpack(head)[0]
+        crossing = Signal()
+        m.d.comb += crossing.eq((data[msb] != fields[0][msb]) | (data == 0))
+
+        def pop():
+            return [
+                self.fifo.r_en.eq(1),
+            ]
+
+        def output():
+            return [ self.o.valid.eq(1) ] + [ f.eq(v) for f, v in zip(fields, self.unpack(head)) ]
+
+        with m.If(self.o.valid & self.o.ready):
+            m.d.sync += self.o.valid.eq(0)
+
+        with m.FSM(reset="IDLE"):
+
+            with m.State("IDLE"):
+                with m.If(self.tick & self.primed & ~self.o.valid):
+                    with m.If(~self.fifo.r_rdy):
+                        # empty : repeat the last sample
+                        m.d.sync += [
+                            self.o.valid.eq(1),
+                            self.repeats.eq(self.repeats + 1),
+                        ]
+                    with m.Elif((level < self.low) & crossing):
+                        m.d.sync += [
+                            self.o.valid.eq(1),
+                            self.repeats.eq(self.repeats + 1),
+                        ]
+                    with m.Elif((level > self.high) & crossing):
+                        m.d.comb += pop()
+                        m.d.sync += self.drops.eq(self.drops + 1)
+                        m.next = "DROP"
+                    with m.Else():
+                        m.d.comb += pop()
+                        m.d.sync += output()
+
+            with m.State("DROP"):
+                with m.If(self.fifo.r_rdy):
+                    m.d.comb += pop()
+                    m.d.sync += output()
+                with m.Else():
+                    m.d.sync += self.o.valid.eq(1)
+                m.next = "IDLE"
+
+        return m
+
+#   FIN
@@ -39,10 +39,10 @@ class GpioIn(Elaboratable):
 
 class GpioOut(Elaboratable):
 
-    def __init__(self, width, name="GpioOut"):
+    def __init__(self, width, reset=0, name="GpioOut"):
         self.name = name
         self.width = width
-        self.o = Signal(width)
+        self.o = Signal(width, reset=reset)
         self.i = Stream(layout=[("data", width),], name="i")
 
     def elaborate(self, platform):
@@ -0,0 +1,126 @@
+
+from amaranth import *
+from amaranth.utils import bits_for
+
+from streams import Stream
+
+from readback import Registers
+from tap import Taps
+
+#
+#   Measure the latency from the selected input to each output.
+#
+#   tap_in() watches the left stream of each input, tap_out() the left
+#   stream of each output. A sample on the input of 'channel' that differs
+#   from the previous one is stamped with the free-running 'time'. The
+#   first sample on each output with the same value gives the latency, in
+#   clocks, for that (channel, output) route. A sample that doesn't arrive
+#   within 'timeout' clocks is discarded, as happens during a crossfade.
+#
+#   The min / max / mean of each route are read back as a packet on 'o',
+#   requested by a packet on 'ci' : for each channel, for each output, the
+#   min, max and mean. The mean is a moving average with 'point' fractional
+#   bits.
+
+class Latency(Elaboratable):
+
+    def __init__(self, chans, outputs, width, timeout, point=4, name="Latency"):
+        self.name = name
+        self.chans = chans
+        self.outputs = outputs
+        self.timeout = timeout
+        self.point = point
+
+        tbits = bits_for(timeout)
+        self.time = Signal(tbits)
+        self.t0 = Signal(tbits)
+        self.elapsed = Signal(tbits)
+
+        self.in_taps = Taps(chans, width, prefix="in_")
+        self.in_strobe = self.in_taps.strobe
+        self.in_sample = self.in_taps.sample
+        self.tap_in = self.in_taps.tap
+        self.out_taps = Taps(outputs, width, prefix="out_")
+        self.out_strobe = self.out_taps.strobe
+        self.out_sample = self.out_taps.sample
+        self.tap_out = self.out_taps.tap
+
+        self.channel = Signal(range(chans))
+        self.chan = Signal(range(chans))
+        self.armed = Signal()
+        self.done = Signal(outputs)
+        self.prev = Signal(width)
+        self.value = Signal(width)
+
+        # stats for each output, for each channel
+        def stats(name, width, **kwargs):
+            return [ [ Signal(width, name=f"{name}_{c}_{k}", **kwargs) for c in range(chans) ] for k in range(outputs) ]
+        self.mins = stats("min", tbits, reset=-1)
+        self.maxs = stats("max", tbits)
+        self.means = stats("mean", tbits + point)
+        self.seen = [ Signal(chans, name=f"seen_{k}") for k in range(outputs) ]
+
+        regs = []
+        for c in range(chans):
+            for k in range(outputs):
+                regs += [ self.mins[k][c], self.maxs[k][c], self.means[k][c] ]
+        self.regs = Registers(regs, name=f"{name}.regs")
+        self.ci = self.regs.i
+        self.o = self.regs.o
+
+        self.mods = [
+            self.regs,
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mods
+
+        m.d.sync += self.time.eq(self.time + 1)
+        m.d.comb += self.elapsed.eq(self.time - self.t0)
+
+        strobe = Array(self.in_strobe)[self.channel]
+        sample = Array(self.in_sample)[self.channel]
+
+        with m.If(self.armed & ((self.elapsed == self.timeout) | self.done.all())):
+            m.d.sync += self.armed.eq(0)
+
+        with m.If(strobe):
+            m.d.sync += self.prev.eq(sample)
+            with m.If((~self.armed) & (sample != self.prev)):
+                m.d.sync += [
+                    self.armed.eq(1),
+                    self.t0.eq(self.time),
+                    self.value.eq(sample),
+                    self.chan.eq(self.channel),
+                    self.done.eq(0),
+                ]
+
+        # update the stats for the route
+        lat = self.elapsed
+        fixed = Signal(len(self.means[0][0]))
+        m.d.comb += fixed.eq(lat << self.point)
+
+        for k in range(self.outputs):
+            with m.If(self.armed & ~self.done[k]):
+                with m.If(self.out_strobe[k] & (self.out_sample[k] == self.value)):
+                    lo = Array(self.mins[k])[self.chan]
+                    hi = Array(self.maxs[k])[self.chan]
+                    mean = Array(self.means[k])[self.chan]
+                    seen = self.seen[k].bit_select(self.chan, 1)
+                    m.d.sync += [
+                        self.done[k].eq(1),
+                        seen.eq(1),
+                    ]
+                    with m.If(lat < lo):
+                        m.d.sync += lo.eq(lat)
+                    with m.If(lat > hi):
+                        m.d.sync += hi.eq(lat)
+                    with m.If(seen):
+                        m.d.sync += mean.eq(mean + ((fixed - mean) >> self.point))
+                    with m.Else():
+                        m.d.sync += mean.eq(fixed)
+
+        return m
+
+#   FIN
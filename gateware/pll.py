@@ -12,6 +12,13 @@
 #   (and others, for different devices)
 
 import re
+import json
+import hashlib
+import os
+import atexit
+import itertools
+
+import numpy as np
 
 from amaranth import *
 from amaranth.lib.cdc import ResetSynchronizer
@@ -245,15 +252,173 @@ device_limits = {
     },
 }
 
+#
+#   Vectorised divider search.
+#
+#   The grid of (sdiv, idiv, fbdiv, odiv) candidates only depends on fin and
+#   the device limits, so it is built once and reused for every fout.
+#   Candidates are ranked in the same order as the original nested loops
+#   (sdiv, idiv, fbdiv, odiv), so ties resolve to the same config.
+
+class Solver:
+
+    idiv_range = list(range(0, 64))
+    fbdiv_range = list(range(0, 64))
+    odiv_range = [ 2, 4, 8, 16, 32, 48, 64, 80, 96, 112, 128 ]
+    # 1 means don't use sdiv, so use clk_out, otherwise use clk_outd 
+    sdiv_range = [ 1 ] + list(range(2, 41, 2))
+
+    _solvers = {}
+
+    @classmethod
+    def get(cls, fin, limits):
+        key = (fin, tuple(sorted(limits.items())))
+        solver = cls._solvers.get(key)
+        if solver is None:
+            solver = cls(fin, limits)
+            cls._solvers[key] = solver
+        return solver
+
+    def __init__(self, fin, limits):
+        self.fin = fin
+        self.limits = limits
+
+        # axes : sdiv, idiv, fbdiv, odiv
+        sdiv = np.array(self.sdiv_range, dtype=np.int64).reshape(-1, 1, 1, 1)
+        idiv = np.array(self.idiv_range, dtype=np.int64).reshape(1, -1, 1, 1)
+        fbdiv = np.array(self.fbdiv_range, dtype=np.int64).reshape(1, 1, -1, 1)
+        odiv = np.array(self.odiv_range, dtype=np.int64).reshape(1, 1, 1, -1)
+        shape = (sdiv.size, idiv.size, fbdiv.size, odiv.size)
+
+        def valid(f, lo, hi): return (limits[lo] <= f) & (f <= limits[hi])
+
+        # Same expressions (and evaluation order) as the scalar search,
+        # so the float results are bit-identical.
+        pfd = fin / (idiv + 1)
+        vco = fin * (fbdiv + 1) * odiv / (idiv + 1)
+        ckout = fin * (fbdiv + 1) / ((idiv + 1) * sdiv)
+
+        mask = valid(pfd, 'pfd_min', 'pfd_max')
+        mask = mask & valid(vco, 'vco_min', 'vco_max')
+        mask = mask & valid(ckout, 'clkout_min', 'clkout_max')
+        mask = np.broadcast_to(mask, shape)
+
+        # only keep the candidates that meet the fin dependent constraints
+        self.index = np.flatnonzero(mask)
+        s, i, f, o = np.unravel_index(self.index, shape)
+        self.sdiv = sdiv.ravel()[s]
+        self.idiv = idiv.ravel()[i]
+        self.fbdiv = fbdiv.ravel()[f]
+        self.odiv = odiv.ravel()[o]
+        self.vco = np.broadcast_to(vco, shape).ravel()[self.index]
+        self.ckout = np.broadcast_to(ckout, shape).ravel()[self.index]
+
+    def solve(self, fout, n=1):
+        # Return up to n configs, best first
+        limits = self.limits
+        fbdiv_pfd = fout / (self.fbdiv + 1)
+        mask = (limits['pfd_min'] <= fbdiv_pfd) & (fbdiv_pfd <= limits['pfd_max'])
+        err = np.abs(fout - self.ckout)
+        # the search only accepts errors smaller than fin
+        mask &= err < self.fin
+
+        idx = np.flatnonzero(mask)
+        # stable sort keeps the nested loop order for equal errors
+        idx = idx[np.argsort(err[idx], kind="stable")[:n]]
+
+        configs = []
+        for k in idx:
+            e = float(err[k])
+            configs.append(dict(fin=self.fin,
+                            freq=fout,
+                            ckout=float(self.ckout[k]),
+                            vco=float(self.vco[k]),
+                            idiv=int(self.idiv[k]),
+                            fbdiv=int(self.fbdiv[k]),
+                            odiv=int(self.odiv[k]),
+                            sdiv=int(self.sdiv[k]),
+                            percent=100*abs(e/fout),
+                            err=e,
+            ))
+        return configs
+
+#
+#   Persistent cache of PLL solutions.
+#
+#   Entries are keyed by a hash of the device limits record, fin and fout,
+#   so editing a device_limits entry makes the old solutions unreachable.
+#
+#   Opt-in : pass a Cache to PLL(), eg. Cache.in_dir(build_dir). New entries
+#   are written back once, at exit.
+
+class Cache:
+
+    # bump if the solver or instance_params() output changes
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.dirty = False
+
+    @classmethod
+    def in_dir(cls, dirname):
+        # the cache file in a build output directory
+        return cls(os.path.join(dirname, "pll_cache.json"))
+
+    def key(self, fin, fout, limits):
+        text = json.dumps([ self.version, fin, fout, limits ], sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def load(self):
+        if self.entries is None:
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, fin, fout, limits):
+        entry = self.load().get(self.key(fin, fout, limits))
+        if entry is None:
+            return None
+        return dict(entry['config']), dict(entry['params'])
+
+    def put(self, fin, fout, limits, config, params):
+        entry = dict(config=dict(config), params=dict(params))
+        self.load()[self.key(fin, fout, limits)] = entry
+        if not self.dirty:
+            self.dirty = True
+            atexit.register(self.save)
+
 #
 #
 
 class PLL(Elaboratable):
 
-    def __init__(self, fin, fout, limits):
+    def __init__(self, fin, fout, limits, cache=None):
         self.limits = limits
-        self.config = self.calc(fin, fout, limits)
-        self.params = self.instance_params(self.config, limits['device'])
+        hit = cache and cache.get(fin, fout, limits)
+        if hit:
+            self.config, self.params = hit
+        else:
+            self.config = self.calc(fin, fout, limits)
+            self.params = self.instance_params(self.config, limits['device'])
+            if cache and self.config:
+                cache.put(fin, fout, limits, self.config, self.params)
         #print(self.config)
 
         self.clk_in = Signal()
@@ -280,59 +445,10 @@ class PLL(Elaboratable):
 
     @classmethod
     def calc(cls, fin, fout, limits):
-        idiv_range = list(range(0, 64))
-        fbdiv_range = list(range(0, 64))
-        odiv_range = [ 2, 4, 8, 16, 32, 48, 64, 80, 96, 112, 128 ]
-        # 1 means don't use sdiv, so use clk_out, otherwise use clk_outd 
-        sdiv_range = [ 1 ] + list(range(2, 41, 2))
-
-        def pfd_valid(f): return limits['pfd_min'] <= f <= limits['pfd_max']
-        def vco_valid(f): return limits['vco_min'] <= f <= limits['vco_max']
-        def clock_valid(f): return limits['clkout_min'] <= f <= limits['clkout_max']
-
-        err_max = fin
-        config = {}
-
-        for sdiv in sdiv_range:
-            for idiv in idiv_range:
-                for fbdiv in fbdiv_range:
-                    for odiv in odiv_range:
-                        # Check the Phase Frequency Detector is within range
-                        # on both inputs of the phase detector.
-                        pfd = fin / (idiv + 1)
-                        if not pfd_valid(pfd):
-                            continue
-                        pfd = fout / (fbdiv + 1)
-                        if not pfd_valid(pfd):
-                            continue
-
-                        # Check VCO range
-                        vco = fin * (fbdiv + 1) * odiv / (idiv + 1)
-                        if not vco_valid(vco):
-                            continue
-
-                        # Check clock out range
-                        ckout = fin * (fbdiv + 1) / ((idiv + 1) * sdiv)
-                        if not clock_valid(ckout):
-                            continue
-
-                        err = abs(fout - ckout)
-                        if err < err_max:
-                            err_max = err
-                            config = dict(fin=fin, 
-                                        freq=fout, 
-                                        ckout=ckout, 
-                                        vco=vco,
-                                        idiv=idiv,
-                                        fbdiv=fbdiv,
-                                        odiv=odiv,
-                                        sdiv=sdiv,
-                                        percent=100*abs(err/fout),
-                                        err=err,
-                            )
-                            if err == 0.0:
-                                return config
-        return config
+        configs = Solver.get(fin, limits).solve(fout, n=1)
+        if not configs:
+            return {}
+        return configs[0]
 
     @classmethod
     def instance_params(cls, params, device):
@@ -374,6 +490,144 @@ class PLL(Elaboratable):
 
         return d
 
+#
+#   Multi-output planner.
+#
+#   The rPLL has one VCO driving CLKOUT, with CLKOUTD = CLKOUT / sdiv and
+#   CLKOUTD3 = CLKOUT / 3. Search for a single CLKOUT that places every
+#   requested frequency on one of those ports, minimising the worst error.
+
+class Planner:
+
+    ports = [ "CLKOUT", "CLKOUTD", "CLKOUTD3" ]
+
+    def __init__(self, fin, limits):
+        self.fin = fin
+        self.limits = limits
+
+        # CLKOUT candidates are the sdiv == 1 entries of the solver grid
+        solver = Solver.get(fin, limits)
+        idx = np.flatnonzero(solver.sdiv == 1)
+        self.idiv = solver.idiv[idx]
+        self.fbdiv = solver.fbdiv[idx]
+        self.odiv = solver.odiv[idx]
+        self.vco = solver.vco[idx]
+        self.clkout = solver.ckout[idx]
+        self.sdiv_range = np.array(Solver.sdiv_range[1:])
+
+    def port_outputs(self, port, fout):
+        # Returns (ckout, sdiv, relative error) for every CLKOUT candidate
+        limits = self.limits
+        def valid(f): return (limits['clkout_min'] <= f) & (f <= limits['clkout_max'])
+
+        if port == "CLKOUT":
+            ckout = self.clkout
+            sdiv = np.ones_like(self.idiv)
+        elif port == "CLKOUTD3":
+            ckout = self.clkout / 3
+            sdiv = np.ones_like(self.idiv)
+        else:
+            ck = self.clkout[:,None] / self.sdiv_range[None,:]
+            err = np.where(valid(ck), np.abs(fout - ck), np.inf)
+            best = np.argmin(err, axis=1)
+            rows = np.arange(len(ck))
+            ckout = ck[rows, best]
+            sdiv = self.sdiv_range[best]
+
+        err = np.where(valid(ckout), np.abs(fout - ckout) / fout, np.inf)
+        return ckout, sdiv, err
+
+    def plan(self, fouts, n=1):
+        # Return up to n plans, best first
+        assert 0 < len(fouts) <= len(self.ports), fouts
+
+        outputs = {}
+        for port in self.ports:
+            for i, fout in enumerate(fouts):
+                outputs[(port, i)] = self.port_outputs(port, fout)
+
+        perms = list(itertools.permutations(self.ports, len(fouts)))
+        worst, total = [], []
+        for ports in perms:
+            errs = np.array([ outputs[(port, i)][2] for i, port in enumerate(ports) ])
+            worst.append(errs.max(axis=0))
+            total.append(errs.sum(axis=0))
+        worst = np.concatenate(worst)
+        total = np.concatenate(total)
+        ncand = len(self.clkout)
+
+        plans = []
+        seen = set()
+        for j in np.lexsort((total, worst)):
+            if (len(plans) == n) or not np.isfinite(worst[j]):
+                break
+            ports, k = perms[j // ncand], j % ncand
+            # different dividers can give the same set of clocks
+            clocks = tuple((port, float(outputs[(port, i)][0][k])) for i, port in enumerate(ports))
+            if clocks in seen:
+                continue
+            seen.add(clocks)
+            sdiv = 1
+            report = []
+            for i, port in enumerate(ports):
+                ckout, sd, _ = outputs[(port, i)]
+                if port == "CLKOUTD":
+                    sdiv = int(sd[k])
+                err = abs(fouts[i] - ckout[k])
+                report.append(dict(port=port,
+                            freq=fouts[i],
+                            ckout=float(ckout[k]),
+                            percent=float(100*abs(err/fouts[i])),
+                            err=float(err),
+                ))
+            plans.append(dict(fin=self.fin,
+                            vco=float(self.vco[k]),
+                            clkout=float(self.clkout[k]),
+                            idiv=int(self.idiv[k]),
+                            fbdiv=int(self.fbdiv[k]),
+                            odiv=int(self.odiv[k]),
+                            sdiv=sdiv,
+                            percent=100*float(worst[j]),
+                            outputs=report,
+            ))
+        return plans
+
+#
+#   One PLL instance generating several clocks from a shared VCO.
+#   clk_out[i] is the clock for fouts[i].
+#   max_error : the worst error allowed on any output, in percent
+
+class MultiPLL(Elaboratable):
+
+    def __init__(self, fin, fouts, limits, max_error=0.1):
+        self.limits = limits
+        plans = Planner(fin, limits).plan(fouts)
+        if not plans:
+            raise Exception(f"no PLL plan for {fouts} from {fin}")
+        if plans[0]['percent'] > max_error:
+            raise Exception(f"no PLL plan for {fouts} from {fin} within {max_error}%, best is {plans[0]['percent']:.3g}%")
+        self.config = plans[0]
+        self.params = PLL.instance_params(self.config, limits['device'])
+
+        self.clk_in = Signal()
+        self.rst_in = Signal()
+        self.clk_out = [ Signal(name=f"clk_out{i}") for i in range(len(fouts)) ]
+        self.locked = Signal()
+
+        self.params.update(
+            i_CLKIN=self.clk_in,
+            i_RESET=self.rst_in,
+            o_LOCK=self.locked,
+        )
+        for output, clk in zip(self.config['outputs'], self.clk_out):
+            self.params[f"o_{output['port']}"] = clk
+
+    def elaborate(self, _):
+        m = Module()
+        self.instance = Instance(self.limits['pll_name'], **self.params)
+        m.submodules += self.instance
+        return m
+
 #
 #
 
@@ -410,4 +664,12 @@ if __name__ == "__main__":
         pll = PLL(fin, f, limits) 
         print(f, *[ params[field] for field in [ 'vco', 'ckout', 'percent', 'sdiv' ] ])
 
+    # Plan sys = Fs*3072 plus the Fs*1024 and Fs*512 audio clocks on one PLL
+    fin = 49.152
+    fouts = [ 49.152 * 3, 49.152, 24.576 ]
+    for plan in Planner(fin, limits).plan(fouts, n=3):
+        print("plan", *[ plan[field] for field in [ 'vco', 'clkout', 'percent', 'sdiv' ] ])
+        for output in plan['outputs']:
+            print("    ", *[ output[field] for field in [ 'port', 'freq', 'ckout', 'percent' ] ])
+
 #   FIN
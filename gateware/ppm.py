@@ -1,12 +1,18 @@
 
+import math
+
 from amaranth import *
 from amaranth.utils import bits_for
+from amaranth.lib.memory import Memory
 
-from streams.stream import Stream, Split
+from streams.stream import Stream, Split, Tee
 from streams.ops import Abs, Decimate, UnaryOp, Delta, Max
 
 from streams.ram import DualPortMemory
 
+from readback import Registers
+from tap import Taps
+
 class Boxcar(Elaboratable):
 
     def __init__(self, width, depth):
@@ -83,6 +89,105 @@ class Boxcar(Elaboratable):
 
         return m
 
+#
+#   Pipelined Boxcar : accepts one sample per clock.
+#
+#   The new sample is written to the same address that the old one is read
+#   from, relying on the read-before-write of the DualPortMemory. The old
+#   sample arrives on the next clock, where the running sum is updated.
+#
+#   With chans > 1 the streams carry a "chan" field and a running sum is kept
+#   for each channel. The channels share one memory of depth * chans,
+#   addressed by chan * depth + ptr.
+
+class PipelinedBoxcar(Elaboratable):
+
+    def __init__(self, width, depth, chans=1):
+        assert (depth & (depth - 1)) == 0, "depth must be a power of 2"
+        self.name = f"PipelinedBoxcar({depth})"
+        if chans > 1:
+            self.name = f"PipelinedBoxcar({depth}x{chans})"
+        self.chans = chans
+        self.mem = DualPortMemory(width=width, depth=depth*chans)
+        self.mem.dot_dont_expand = True
+        layout = [ ("data", width) ]
+        if chans > 1:
+            layout += [ ("chan", bits_for(chans-1)) ]
+        self.i = Stream(layout=layout, name="i")
+        self.o = Stream(layout=layout, name="o")
+
+        # stage 1 : waiting for the old sample
+        self.s1_valid = Signal()
+        self.s1_data = Signal(signed(width))
+        self.s1_chan = Signal(range(chans))
+        # the read data is only valid for 1 clock, so hold it over a stall
+        self.fresh = Signal()
+        self.held = Signal(signed(width))
+        self.prev = Signal(signed(width))
+
+        sum_width = bits_for(depth) + width + 1
+        self.sums = Array([ Signal(signed(sum_width), name=f"sum{i}") for i in range(chans) ])
+        self.next_sum = Signal(signed(sum_width))
+        self.shift = bits_for(depth) - 1
+
+        self.ptrs = Array([ Signal(range(depth), name=f"ptr{i}") for i in range(chans) ])
+        self.chan = Signal(range(chans))
+        self.advance = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mem
+
+        accept = Signal()
+
+        if self.chans > 1:
+            m.d.comb += self.chan.eq(self.i.chan)
+
+        ptr = self.ptrs[self.chan]
+        total = self.sums[self.s1_chan]
+
+        m.d.comb += [
+            # output register is free, so stage 1 can move on
+            self.advance.eq(self.o.ready | ~self.o.valid),
+            self.i.ready.eq(self.advance | ~self.s1_valid),
+            accept.eq(self.i.valid & self.i.ready),
+
+            self.mem.rd.addr.eq(Cat(ptr, self.chan)),
+            self.mem.wr.addr.eq(Cat(ptr, self.chan)),
+            self.mem.wr.data.eq(self.i.data),
+            self.mem.wr.en.eq(accept),
+
+            self.prev.eq(Mux(self.fresh, self.mem.rd.data, self.held)),
+            self.next_sum.eq(total + self.s1_data - self.prev),
+        ]
+
+        m.d.sync += self.fresh.eq(accept)
+        with m.If(self.fresh):
+            m.d.sync += self.held.eq(self.mem.rd.data)
+
+        with m.If(self.o.valid & self.o.ready):
+            m.d.sync += self.o.valid.eq(0)
+
+        with m.If(self.s1_valid & self.advance):
+            m.d.sync += [
+                self.s1_valid.eq(0),
+                total.eq(self.next_sum),
+                self.o.data.eq(self.next_sum >> self.shift),
+                self.o.valid.eq(1),
+            ]
+            if self.chans > 1:
+                m.d.sync += self.o.chan.eq(self.s1_chan)
+
+        with m.If(accept):
+            m.d.sync += [
+                self.s1_valid.eq(1),
+                self.s1_data.eq(self.i.data),
+                self.s1_chan.eq(self.chan),
+                ptr.eq(ptr + 1),
+            ]
+
+        return m
+
 #
 #
 #   'point' is the number of fractional bits used for the decay
@@ -158,18 +263,232 @@ class StereoAbs(Elaboratable):
 
         return m
 
+#
+#   Peak of each group of (1 << rate) samples.
+#
+#   Brings a rectified signal at fs * 2^rate back to fs, without losing the
+#   peaks, so the ballistics that follow are the same at every rate.
+
+class MaxDecimate(Elaboratable):
+
+    def __init__(self, width, rates=1, name="MaxDecimate"):
+        self.name = name
+        self.i = Stream(layout=[("data", width)], name="i")
+        self.o = Stream(layout=[("data", width)], name="o")
+
+        self.rate = Signal(range(rates))
+        self.count = Signal(range(1 << (rates - 1)))
+        self.peak = Signal(width)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        with m.If(self.o.valid & self.o.ready):
+            m.d.sync += self.o.valid.eq(0)
+
+        m.d.comb += self.i.ready.eq(~self.o.valid)
+
+        with m.If(self.i.valid & self.i.ready):
+            top = Mux((self.count == 0) | (self.i.data > self.peak), self.i.data, self.peak)
+            with m.If(self.count == ((1 << self.rate) - 1)):
+                m.d.sync += [
+                    self.o.data.eq(top),
+                    self.o.valid.eq(1),
+                    self.count.eq(0),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    self.peak.eq(top),
+                    self.count.eq(self.count + 1),
+                ]
+
+        return m
+
+#
+#   True peak level, as BS.1770 : the stereo signal is upsampled x4 by a
+#   polyphase interpolator and the peak of the interpolated samples taken.
+#
+#   One multiplier is shared by all the phases and both channels, so each
+#   sample takes 2 * 4 * 12 MAC cycles, plus a few to empty the pipeline.
+#   The output has the same layout as StereoAbs, but can go above full
+#   scale, saturating at the maximum unsigned value.
+#
+#   It replaces StereoAbs rather than following it, as the filter needs the
+#   signed samples.
+#
+#   At fs * 2^rate the input is already oversampled, so only every
+#   (1 << rate)th phase is run : the work per second is the same at every
+#   rate.
+
+class TruePeak(Elaboratable):
+
+    # BS.1770-4 Annex 2 interpolating filter, in units of 1/8192
+    phase0 = [ 14, 90, -161, 272, -487, 1125, 7964, -838, 390, -218, 122, -68 ]
+    phase1 = [ -239, 240, -424, 730, -1364, 3810, 6388, -1641, 832, -477, 271, -155 ]
+    coefs = [ phase0, phase1, phase1[::-1], phase0[::-1] ]
+    point = 13
+    cwidth = 16
+
+    def __init__(self, layout=None, rates=1, name="TruePeak"):
+        assert (1 << (rates - 1)) <= len(self.coefs)
+        self.name = name
+        self.i = Stream(layout=layout, name="i")
+        width = layout[0][1]
+        self.width = width
+        self.o = Stream(layout=[("data", width)], name="o")
+
+        self.taps = len(self.phase0)
+        self.phases = len(self.coefs)
+        self.bits = bits_for(self.taps - 1)
+
+        # the last 'taps' samples of each channel
+        self.mem = DualPortMemory(width=width, depth=2 << self.bits)
+        self.mem.dot_dont_expand = True
+
+        self.rom = Memory(shape=signed(self.cwidth), depth=self.phases << self.bits, init=self.table())
+
+        self.left = Signal(signed(width))
+        self.right = Signal(signed(width))
+        self.ptr = Signal(self.bits)
+
+        # MAC sequence
+        self.chan = Signal()
+        self.phase = Signal(range(self.phases))
+        self.tap = Signal(range(self.taps))
+        self.rate = Signal(range(rates))
+
+        acc_width = width + self.cwidth + bits_for(self.taps)
+        self.prod = Signal(signed(width + self.cwidth))
+        self.acc = Signal(signed(acc_width))
+        self.peak = Signal(acc_width - self.point)
+
+        # pipeline flags : Cat(valid, first tap, last tap)
+        self.s1 = Signal(3)
+        self.s2 = Signal(3)
+        self.s3 = Signal(3)
+
+    def table(self):
+        t = []
+        for phase in self.coefs:
+            t += phase + [ 0 ] * ((1 << self.bits) - len(phase))
+        return t
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mem
+        m.submodules.rom = self.rom
+        rd = self.rom.read_port()
+
+        wr_chan = Signal()
+        m.d.comb += [
+            self.mem.wr.addr.eq(Cat(self.ptr, wr_chan)),
+            self.mem.wr.data.eq(Mux(wr_chan, self.right, self.left)),
+            self.mem.rd.addr.eq(Cat((self.ptr - self.tap)[:self.bits], self.chan)),
+            rd.addr.eq(Cat(self.tap[:self.bits], self.phase)),
+        ]
+
+        # MAC pipeline : read, multiply, accumulate, compare
+        level = Signal(len(self.peak))
+        m.d.comb += level.eq(abs(self.acc >> self.point))
+        m.d.sync += [
+            self.s2.eq(self.s1),
+            self.s3.eq(self.s2),
+            self.prod.eq(self.mem.rd.data.as_signed() * rd.data),
+        ]
+        with m.If(self.s2[0]):
+            m.d.sync += self.acc.eq(Mux(self.s2[1], 0, self.acc) + self.prod)
+        with m.If(self.s3[0] & self.s3[2] & (level > self.peak)):
+            m.d.sync += self.peak.eq(level)
+
+        busy = Signal()
+        m.d.comb += busy.eq(self.s1[0] | self.s2[0] | self.s3[0])
+
+        with m.FSM(reset="IDLE"):
+
+            with m.State("IDLE"):
+                with m.If(~self.i.ready):
+                    m.d.sync += self.i.ready.eq(1)
+
+                with m.If(self.i.valid & self.i.ready):
+                    m.d.sync += [
+                        self.i.ready.eq(0),
+                        self.left.eq(self.i.left),
+                        self.right.eq(self.i.right),
+                        self.ptr.eq(self.ptr + 1),
+                    ]
+                    m.next = "LEFT"
+
+            with m.State("LEFT"):
+                m.d.comb += self.mem.wr.en.eq(1)
+                m.next = "RIGHT"
+
+            with m.State("RIGHT"):
+                m.d.comb += [
+                    wr_chan.eq(1),
+                    self.mem.wr.en.eq(1),
+                ]
+                m.d.sync += [
+                    self.chan.eq(0),
+                    self.phase.eq(0),
+                    self.tap.eq(0),
+                    self.peak.eq(0),
+                ]
+                m.next = "RUN"
+
+            with m.State("RUN"):
+                end = self.tap == (self.taps - 1)
+                m.d.sync += [
+                    self.s1.eq(Cat(1, self.tap == 0, end)),
+                    self.tap.eq(self.tap + 1),
+                ]
+                with m.If(end):
+                    m.d.sync += [
+                        self.tap.eq(0),
+                        self.phase.eq(self.phase + (1 << self.rate)),
+                    ]
+                    with m.If(self.phase == (self.phases - (1 << self.rate))):
+                        m.d.sync += [
+                            self.chan.eq(1),
+                            self.phase.eq(0),
+                        ]
+                        with m.If(self.chan):
+                            m.next = "DRAIN"
+
+            with m.State("DRAIN"):
+                m.d.sync += self.s1.eq(0)
+                with m.If(~busy):
+                    m.d.sync += [
+                        self.o.data.eq(Mux(self.peak >> self.width, (1 << self.width) - 1, self.peak)),
+                        self.o.valid.eq(1),
+                    ]
+                    m.next = "WAIT"
+
+            with m.State("WAIT"):
+                with m.If(self.o.valid & self.o.ready):
+                    m.d.sync += [
+                        self.o.valid.eq(0),
+                        self.i.ready.eq(1),
+                    ]
+                    m.next = "IDLE"
+
+        return m
+
 #
 #
 
 class PPM(Elaboratable):
 
-    def __init__(self, layout=None, name="PPM"):
+    def __init__(self, layout=None, name="PPM", pipelined=False):
         # expects a 48kHz input signal, rectified by Abs()
         self.name = name
         width = layout[0][1]
 
         # 48kHz/512 ~ 10ms average
-        self.rise = Boxcar(width, 512)
+        if pipelined:
+            # accepts a sample every clock
+            self.rise = PipelinedBoxcar(width, 512)
+        else:
+            self.rise = Boxcar(width, 512)
         self.decimate = Decimate(32, layout=layout)
         decay = int((1<<5)/width)
         self.peak = PeakHold(decay, point=8, name=f"PeakHold({decay})", layout=layout)
@@ -197,6 +516,582 @@ class PPM(Elaboratable):
 
         return m
 
+#
+#   Fixed point log2 of a level : 'frac' fractional bits.
+#
+#   The integer part is the msb position, the fractional part is looked up
+#   in a ROM indexed by the 'lbits' bits below the msb. log2(0) gives 0.
+
+class Log2(Elaboratable):
+
+    def __init__(self, iwidth, frac=12, lbits=6, name="Log2"):
+        self.name = name
+        self.iwidth = iwidth
+        self.frac = frac
+        self.lbits = lbits
+        self.owidth = bits_for(iwidth - 1) + frac
+        self.i = Stream(layout=[("data", iwidth)], name="i")
+        self.o = Stream(layout=[("data", self.owidth)], name="o")
+
+        self.rom = Memory(shape=frac, depth=1 << lbits, init=self.table())
+
+        self.msb = Signal(range(iwidth))
+
+    def table(self):
+        t = []
+        for m in range(1 << self.lbits):
+            f = round(math.log2(1 + (m / (1 << self.lbits))) * (1 << self.frac))
+            t.append(min(f, (1 << self.frac) - 1))
+        return t
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.rom = self.rom
+        rd = self.rom.read_port()
+
+        # priority encode the msb, left justify the bits below it
+        msb = Signal(range(self.iwidth))
+        mant = Signal(self.lbits)
+        for b in range(1, self.iwidth):
+            with m.If(self.i.data[b]):
+                m.d.comb += msb.eq(b)
+                if b >= self.lbits:
+                    m.d.comb += mant.eq(self.i.data[b-self.lbits:b])
+                else:
+                    m.d.comb += mant.eq(Cat(Const(0, self.lbits-b), self.i.data[:b]))
+
+        m.d.comb += rd.addr.eq(mant)
+
+        with m.FSM(reset="IDLE"):
+
+            with m.State("IDLE"):
+                with m.If(~self.i.ready):
+                    m.d.sync += self.i.ready.eq(1)
+
+                with m.If(self.i.valid & self.i.ready):
+                    m.d.sync += [
+                        self.i.ready.eq(0),
+                        self.msb.eq(msb),
+                    ]
+                    m.next = "ROM"
+
+            with m.State("ROM"):
+                m.d.sync += [
+                    self.o.data.eq(Cat(rd.data, self.msb)),
+                    self.o.valid.eq(1),
+                ]
+                m.next = "WAIT"
+
+            with m.State("WAIT"):
+                with m.If(self.o.valid & self.o.ready):
+                    m.d.sync += [
+                        self.o.valid.eq(0),
+                        self.i.ready.eq(1),
+                    ]
+                    m.next = "IDLE"
+
+        return m
+
+#
+#   PPM ballistics in the log domain, one step per sample.
+#
+#   Rising : first order IIR, level += (x - level) >> attack.
+#   Falling : a constant 'decay' per sample, so the return is linear in dB,
+#   but never below the input. 'point' extra fractional bits are kept.
+
+class Ballistics(Elaboratable):
+
+    def __init__(self, width, attack, decay, point=12, name=None):
+        self.name = name or f"Ballistics({attack},{decay})"
+        self.attack = attack
+        self.decay = decay
+        self.point = point
+        self.i = Stream(layout=[("data", width)], name="i")
+        self.o = Stream(layout=[("data", width)], name="o")
+
+        self.level = Signal(width + point)
+        self.next = Signal(width + point)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        x = Signal(len(self.level))
+        rise = Signal(len(self.level))
+        fall = Signal(signed(len(self.level) + 1))
+        m.d.comb += [
+            x.eq(self.i.data << self.point),
+            rise.eq(self.level + ((x - self.level) >> self.attack)),
+            fall.eq(self.level - self.decay),
+        ]
+
+        with m.If(x > self.level):
+            m.d.comb += self.next.eq(rise)
+        with m.Elif(fall > x):
+            m.d.comb += self.next.eq(fall)
+        with m.Else():
+            m.d.comb += self.next.eq(x)
+
+        with m.If(self.o.valid & self.o.ready):
+            m.d.sync += [
+                self.o.valid.eq(0),
+                self.i.ready.eq(1),
+            ]
+
+        with m.If((~self.i.ready) & ~self.o.valid):
+            m.d.sync += self.i.ready.eq(1)
+
+        with m.If(self.i.valid & self.i.ready):
+            m.d.sync += [
+                self.i.ready.eq(0),
+                self.level.eq(self.next),
+                self.o.data.eq(self.next >> self.point),
+                self.o.valid.eq(1),
+            ]
+
+        return m
+
+#
+#   PPM working in the log domain.
+#
+#   Output is log2(level) with 'frac' fractional bits, so 1 dB is
+#   (1 << frac) / 6.0206. Defaults are the IEC 60268-10 Type II (BBC)
+#   ballistics : 10ms integration, return of 24dB in 2.8s.
+
+class LogPPM(Elaboratable):
+
+    def __init__(self, layout=None, name="LogPPM", fs=48000, frac=12,
+                 attack_ms=10, return_db=24, return_s=2.8, point=12):
+        # expects an input signal at fs, rectified by Abs()
+        self.name = name
+        width = layout[0][1]
+
+        self.log = Log2(width, frac=frac)
+        log_layout = self.log.o.get_layout()
+
+        # nearest power of 2 to the attack time constant in samples
+        attack = max(0, round(math.log2(attack_ms * fs / 1000)))
+        self.attack_ms = (1 << attack) * 1000 / fs
+        # log2 units per sample, with 'point' more fractional bits
+        steps = return_db / (20 * math.log10(2)) / (return_s * fs)
+        decay = round(steps * (1 << (frac + point)))
+        self.ballistics = Ballistics(self.log.owidth, attack, decay, point=point)
+
+        self.decimate = Decimate(32, layout=log_layout)
+        self.delta = Delta(layout=log_layout)
+
+        self.i = self.log.i
+        self.o = self.delta.o
+
+        self.mods = [
+            self.log,
+            self.ballistics,
+            self.decimate,
+            self.delta,
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules += self.mods
+
+        m.d.comb += Stream.connect(self.log.o, self.ballistics.i)
+        m.d.comb += Stream.connect(self.ballistics.o, self.decimate.i)
+        m.d.comb += Stream.connect(self.decimate.o, self.delta.i)
+
+        return m
+
+#
+#   BS.1770 K-weighting of a stereo signal, giving the power per sample.
+#
+#   The two biquads (high shelf, then RLB high pass) of each channel are
+#   run in direct form I through one shared multiplier, followed by the
+#   square of the output. The output is zl^2 + zr^2, in input LSB^2.
+#
+#   There is a set of coefficients for each sample rate fs * 2^rate, for
+#   rate in range(rates), chosen by 'rate' at run time.
+
+class KWeight(Elaboratable):
+
+    @staticmethod
+    def shelf(fs):
+        # (b0, b1, b2, a1, a2) of the high shelf
+        g, q, fc = 3.999843853973347, 0.7071752369554196, 1681.974450955533
+        k = math.tan(math.pi * fc / fs)
+        vh = 10 ** (g / 20)
+        vb = vh ** 0.4996667741545416
+        a0 = 1 + (k / q) + (k * k)
+        return [ (vh + (vb * k / q) + (k * k)) / a0, 2 * ((k * k) - vh) / a0, (vh - (vb * k / q) + (k * k)) / a0,
+                 2 * ((k * k) - 1) / a0, (1 - (k / q) + (k * k)) / a0 ]
+
+    @staticmethod
+    def rlb(fs):
+        # (b0, b1, b2, a1, a2) of the RLB high pass
+        q, fc = 0.5003270373238773, 38.13547087602444
+        k = math.tan(math.pi * fc / fs)
+        a0 = 1 + (k / q) + (k * k)
+        return [ 1.0, -2.0, 1.0, 2 * ((k * k) - 1) / a0, (1 - (k / q) + (k * k)) / a0 ]
+
+    def __init__(self, layout=None, fs=48000, rates=1, frac=12, point=28, name="KWeight"):
+        self.name = name
+        self.i = Stream(layout=layout, name="i")
+        iwidth = layout[0][1]
+        self.frac = frac
+        self.point = point
+
+        # 2 bits of headroom for the shelf gain
+        width = iwidth + frac + 2
+        cwidth = point + 3
+        self.cwidth = cwidth
+        self.owidth = 2 * (iwidth + 2) + 1
+        self.o = Stream(layout=[("data", self.owidth)], name="o")
+
+        # filter state for each channel : input, shelf output, rlb output
+        def state(name):
+            return Array([ Signal(signed(width), name=f"{name}_{c}") for c in range(2) ])
+        self.x, self.x1, self.x2 = state("x"), state("x1"), state("x2")
+        self.y, self.y1, self.y2 = state("y"), state("y1"), state("y2")
+        self.z, self.z1, self.z2 = state("z"), state("z1"), state("z2")
+        # rounding error of the last rlb output, fed into the next
+        self.e = Array([ Signal(signed(point + 1), name=f"e_{c}") for c in range(2) ])
+
+        def coef(b0, b1, b2, a1, a2):
+            # negate the feedback terms, so every step is an add
+            return [ int(round(c * (1 << point))) for c in [ b0, b1, b2, -a1, -a2 ] ]
+        self.rate = Signal(range(rates))
+        tables = []
+        for r in range(rates):
+            tables.append(coef(*self.shelf(fs << r)) + coef(*self.rlb(fs << r)))
+        # for each step, the coefficient for the rate
+        self.coefs = [ Array([ Const(t[s], signed(cwidth)) for t in tables ])[self.rate] for s in range(len(tables[0])) ]
+        self.steps = len(self.coefs) + 1 # plus the square
+
+        self.chan = Signal()
+        self.step = Signal(range(self.steps))
+        self.prod = Signal(signed(width + cwidth))
+        self.acc = Signal(signed(width + cwidth + 3))
+        self.power = Signal(self.owidth)
+
+    def operands(self, c):
+        # (a, b) for each step of channel 'c'
+        a = [
+            self.x[c], self.x1[c], self.x2[c], self.y1[c], self.y2[c],
+            self.y[c], self.y1[c], self.y2[c], self.z1[c], self.z2[c],
+        ]
+        return [ (a[s], self.coefs[s]) for s in range(len(a)) ] + [ (self.z[c], self.z[c]) ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        c = self.chan
+        a = Signal.like(self.x[0])
+        b = Signal(signed(max(self.cwidth, len(a))))
+        with m.Switch(self.step):
+            for s, (sa, sb) in enumerate(self.operands(c)):
+                with m.Case(s):
+                    m.d.comb += [ a.eq(sa), b.eq(sb) ]
+
+        # first step of each biquad
+        first = (self.step == 0) | (self.step == 5)
+        start = Mux(self.step == 5, self.e[c], 0)
+        total = Signal.like(self.acc)
+        # the filter outputs are rounded : the rlb poles are close to 1,
+        # so the bias of truncation would give a large DC offset. Even
+        # rounded, the rlb sticks at an offset of a few LSBs (more at the
+        # high rates) unless its rounding error is fed back.
+        half = 1 << (self.point - 1)
+        result = Signal.like(self.x[0])
+        error = Signal.like(self.e[0])
+        m.d.comb += [
+            total.eq(Mux(first, start, self.acc) + self.prod),
+            result.eq((total + half) >> self.point),
+            error.eq((total + half)[:self.point] - half),
+        ]
+
+        with m.FSM(reset="IDLE"):
+
+            with m.State("IDLE"):
+                with m.If(~self.i.ready):
+                    m.d.sync += self.i.ready.eq(1)
+
+                with m.If(self.i.valid & self.i.ready):
+                    m.d.sync += [
+                        self.i.ready.eq(0),
+                        self.x[0].eq(self.i.left.as_signed() << self.frac),
+                        self.x[1].eq(self.i.right.as_signed() << self.frac),
+                        self.chan.eq(0),
+                        self.step.eq(0),
+                        self.power.eq(0),
+                    ]
+                    m.next = "MUL"
+
+            with m.State("MUL"):
+                m.d.sync += self.prod.eq(a * b)
+                m.next = "ACC"
+
+            with m.State("ACC"):
+                m.d.sync += [
+                    self.acc.eq(total),
+                    self.step.eq(self.step + 1),
+                ]
+                m.next = "MUL"
+
+                with m.If(self.step == 4):
+                    m.d.sync += self.y[c].eq(result)
+                with m.If(self.step == 9):
+                    m.d.sync += [
+                        self.z[c].eq(result),
+                        self.e[c].eq(error),
+                    ]
+                with m.If(self.step == (self.steps - 1)):
+                    m.d.sync += [
+                        self.power.eq(self.power + (self.prod >> (2 * self.frac))),
+                        self.x2[c].eq(self.x1[c]),
+                        self.x1[c].eq(self.x[c]),
+                        self.y2[c].eq(self.y1[c]),
+                        self.y1[c].eq(self.y[c]),
+                        self.z2[c].eq(self.z1[c]),
+                        self.z1[c].eq(self.z[c]),
+                        self.chan.eq(1),
+                        self.step.eq(0),
+                    ]
+                    with m.If(c):
+                        m.next = "OUT"
+
+            with m.State("OUT"):
+                m.d.sync += [
+                    self.o.data.eq(self.power),
+                    self.o.valid.eq(1),
+                ]
+                m.next = "WAIT"
+
+            with m.State("WAIT"):
+                with m.If(self.o.valid & self.o.ready):
+                    m.d.sync += [
+                        self.o.valid.eq(0),
+                        self.i.ready.eq(1),
+                    ]
+                    m.next = "IDLE"
+
+        return m
+
+#
+#   Sum blocks of 'n' samples, output sum >> shift.
+
+class BlockSum(Elaboratable):
+
+    def __init__(self, n, iwidth, owidth, shift=0, rates=1, name=None):
+        self.name = name or f"BlockSum({n})"
+        self.n = n
+        self.shift = shift
+        self.i = Stream(layout=[("data", iwidth)], name="i")
+        self.o = Stream(layout=[("data", owidth)], name="o")
+
+        # at 'fs << rate' the block is 'n << rate' samples, scaled back to n
+        self.rate = Signal(range(rates))
+        top = n << (rates - 1)
+        self.sum = Signal(iwidth + bits_for(top))
+        self.count = Signal(range(top))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        with m.If(self.o.valid & self.o.ready):
+            m.d.sync += self.o.valid.eq(0)
+
+        m.d.comb += self.i.ready.eq(~self.o.valid)
+
+        with m.If(self.i.valid & self.i.ready):
+            total = self.sum + self.i.data
+            with m.If(self.count == ((self.n << self.rate) - 1)):
+                m.d.sync += [
+                    self.o.data.eq(total >> (self.shift + self.rate)),
+                    self.o.valid.eq(1),
+                    self.sum.eq(0),
+                    self.count.eq(0),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    self.sum.eq(total),
+                    self.count.eq(self.count + 1),
+                ]
+
+        return m
+
+#
+#   Loudness, as EBU R128 : momentary (400ms) and short-term (3s) mean
+#   square of the K-weighted signal.
+#
+#   The power is summed in blocks, and a Boxcar over the blocks gives the
+#   sliding window : 4 blocks of 100ms, and 32 blocks of 93.75ms. A packet
+#   on 'ci' requests the latest values, sent as a packet on 'o'. Use lufs()
+#   to convert them.
+
+class Loudness(Elaboratable):
+
+    def __init__(self, layout=None, fs=48000, rates=1, width=32, name="Loudness"):
+        self.name = name
+        self.i = Stream(layout=layout, name="i")
+        # input at 'fs << rate'
+        self.rate = Signal(range(rates))
+
+        self.kweight = KWeight(layout=layout, fs=fs, rates=rates)
+        iwidth = self.kweight.owidth
+        # (window seconds, boxcar depth)
+        windows = [ (0.4, 4), (3.0, 32) ]
+        self.blocks = []
+        self.sums = []
+        self.boxcars = []
+        for secs, depth in windows:
+            n = int(fs * secs / depth)
+            # leave the Boxcar a sign bit
+            shift = max(0, iwidth + bits_for(n) - (width - 1))
+            self.blocks.append((n, shift))
+            self.sums.append(BlockSum(n, iwidth, width, shift=shift, rates=rates))
+            self.boxcars.append(Boxcar(width, depth))
+
+        self.tee = Tee(layout=self.kweight.o.get_layout(), n=len(windows), wait_all=True)
+
+        self.momentary = Signal(width)
+        self.short_term = Signal(width)
+        self.results = [ self.momentary, self.short_term ]
+
+        self.regs = Registers(self.results, name=f"{name}.regs")
+        self.ci = self.regs.i
+        self.o = self.regs.o
+
+        self.mods = [
+            self.kweight,
+            self.tee,
+            self.regs,
+        ] + self.sums + self.boxcars
+
+    def lufs(self, value, idx):
+        # convert a reading to LUFS, None for silence
+        if not value:
+            return None
+        n, shift = self.blocks[idx]
+        width = self.i.get_layout()[0][1]
+        ms = (value << shift) / (n * (1 << (2 * (width - 1))))
+        return -0.691 + 10 * math.log10(ms)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mods
+
+        m.d.comb += Stream.connect(self.i, self.kweight.i)
+        m.d.comb += Stream.connect(self.kweight.o, self.tee.i)
+
+        m.d.comb += self.kweight.rate.eq(self.rate)
+        for s in self.sums:
+            m.d.comb += s.rate.eq(self.rate)
+
+        for idx, (s, box, result) in enumerate(zip(self.sums, self.boxcars, self.results)):
+            m.d.comb += Stream.connect(self.tee.o[idx], s.i)
+            m.d.comb += Stream.connect(s.o, box.i)
+            m.d.comb += box.o.ready.eq(1)
+            with m.If(box.o.valid):
+                m.d.sync += result.eq(box.o.data)
+
+        return m
+
+#
+#   Peak levels for several channels, sharing one datapath.
+#
+#   tap() watches a Stream without affecting it : each transfer latches the
+#   sample and marks the channel pending. A scheduler visits one channel per
+#   clock, so a single abs / compare / decay updates all the peak registers.
+#   Every 'decay_ms' the peaks fall by peak >> decay_shift.
+#
+#   A packet on 'ci' requests the peak levels, which are sent as a packet on
+#   'o', one word per channel.
+
+class LevelMeter(Elaboratable):
+
+    def __init__(self, n, width, sys_ck, decay_ms=64, decay_shift=4, live=0x10, name="LevelMeter"):
+        self.name = name
+        self.n = n
+        self.width = width
+        self.decay_shift = decay_shift
+        self.decay_period = int(sys_ck * decay_ms / 1000)
+        self.live_level = live
+
+        self.taps = Taps(n, signed(width))
+        self.strobe = self.taps.strobe
+        self.sample = self.taps.sample
+        self.tap = self.taps.tap
+        self.pending = [ Signal(name=f"pending{i}") for i in range(n) ]
+        self.latched = [ Signal(signed(width), name=f"latched{i}") for i in range(n) ]
+        self.peaks = [ Signal(width, name=f"peak{i}") for i in range(n) ]
+
+        # a bit per channel, set if the peak is above the 'live' level
+        self.live = Signal(n)
+
+        self.chan = Signal(range(n))
+        self.decay_count = Signal(range(self.decay_period))
+        self.decay_req = Signal()
+        self.decaying = Signal()
+
+        self.regs = Registers(self.peaks, name=f"{name}.regs")
+        self.ci = self.regs.i
+        self.o = self.regs.o
+
+        self.mods = [
+            self.regs,
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mods
+
+        pending = Array(self.pending)
+        latched = Array(self.latched)
+        peaks = Array(self.peaks)
+
+        # decay timer
+        m.d.sync += self.decay_count.eq(self.decay_count + 1)
+        with m.If(self.decay_count == (self.decay_period - 1)):
+            m.d.sync += [
+                self.decay_count.eq(0),
+                self.decay_req.eq(1),
+            ]
+
+        # decay every channel once : from the sweep after chan 0
+        with m.If(self.chan == (self.n - 1)):
+            m.d.sync += self.chan.eq(0)
+        with m.Else():
+            m.d.sync += self.chan.eq(self.chan + 1)
+        with m.If(self.chan == 0):
+            m.d.sync += [
+                self.decaying.eq(self.decay_req),
+                self.decay_req.eq(0),
+            ]
+
+        # shared datapath
+        peak = peaks[self.chan]
+        level = Signal(self.width)
+        decayed = Signal(self.width)
+        m.d.comb += [
+            level.eq(abs(latched[self.chan])),
+            decayed.eq(Mux(self.decaying, peak - (peak >> self.decay_shift), peak)),
+        ]
+
+        m.d.sync += [
+            pending[self.chan].eq(0),
+            peak.eq(Mux(pending[self.chan] & (level > decayed), level, decayed)),
+        ]
+
+        # latch new samples : after the datapath, so a new sample wins
+        for i in range(self.n):
+            with m.If(self.strobe[i]):
+                m.d.sync += [
+                    self.pending[i].eq(1),
+                    self.latched[i].eq(self.sample[i]),
+                ]
+
+        m.d.comb += self.live.eq(Cat([ p > self.live_level for p in self.peaks ]))
+
+        return m
+
 #
 #
 
@@ -340,6 +1235,146 @@ class BarGraph(Elaboratable):
 
         return m
 
+#
+#   BarGraph using a lookup table instead of the Comparator.
+#
+#   The level is converted to a log index (exponent + 'mant' mantissa bits),
+#   and the brightness of every segment for every index is computed at
+#   elaboration time into a ROM. A packet of n segments is then sent at one
+#   segment per clock, with no multiplier.
+#
+#   If the level is already logarithmic, eg. from LogPPM, set 'log_bits' :
+#   the index is then the top 'log_bits' bits of the level, so the steps
+#   are the same size in dB over the whole range.
+
+class LutBarGraph(Elaboratable):
+
+    def __init__(self, iwidth, owidth, thresholds=None, mant=3, log_bits=None, name=None):
+        assert thresholds
+        assert len(thresholds) > 1
+        self.n = len(thresholds) - 1
+        self.name = name or f"LutBarGraph({self.n})"
+        self.iwidth = iwidth
+        self.owidth = owidth
+        self.mant = mant
+        self.thresholds = thresholds
+        self.end = self.n - 1
+        self.max = (1 << owidth) - 1
+        self.shift = iwidth - owidth
+        self.loss = (iwidth - owidth) - 1
+        assert self.loss
+
+        self.i = Stream(layout=[("data", iwidth)], name="i")
+        self.o = Stream(layout=[("data", owidth)], name="o")
+
+        self.log_bits = log_bits
+        if log_bits:
+            assert log_bits <= iwidth
+            self.idx_bits = log_bits
+            self.idx_shift = iwidth - log_bits
+        else:
+            self.exps = iwidth - mant + 1
+            self.idx_bits = mant + bits_for(self.exps - 1)
+        self.seg_bits = bits_for(self.n - 1)
+
+        self.rom = Memory(shape=owidth, depth=1 << (self.idx_bits + self.seg_bits), init=self.table())
+
+        self.level = Signal(self.idx_bits)
+        self.seg = Signal(range(self.n + 1))
+        self.send = Signal()
+        self.s1_valid = Signal()
+
+    def index(self, data):
+        # log index of a level
+        if self.log_bits:
+            return data >> self.idx_shift
+        if data < (1 << self.mant):
+            return data
+        msb = data.bit_length() - 1
+        e = msb - self.mant + 1
+        return (e << self.mant) | ((data >> (msb - self.mant)) & ((1 << self.mant) - 1))
+
+    def highest(self, idx):
+        # highest level with this index
+        if self.log_bits:
+            return ((idx + 1) << self.idx_shift) - 1
+        e, m = idx >> self.mant, idx & ((1 << self.mant) - 1)
+        if e == 0:
+            return m
+        return (((1 << self.mant) | m) << (e - 1)) | ((1 << (e - 1)) - 1)
+
+    def brightness(self, seg, data):
+        # as the Comparator, given the thresholds for the segment
+        lo, hi = self.thresholds[seg], self.thresholds[seg+1]
+        if data >= hi:
+            return self.max
+        if data <= lo:
+            return 0
+        mul = int((self.max / (hi-lo)) * (1 << self.loss))
+        return ((mul * (data - lo)) >> self.shift) & self.max
+
+    def table(self):
+        t = []
+        for seg in range(1 << self.seg_bits):
+            for idx in range(1 << self.idx_bits):
+                if (seg < self.n) and (self.log_bits or (idx < (self.exps << self.mant))):
+                    t.append(self.brightness(seg, self.highest(idx)))
+                else:
+                    t.append(0)
+        return t
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.rom = self.rom
+        rd = self.rom.read_port()
+
+        idx = Signal(self.idx_bits)
+        if self.log_bits:
+            # already log : the top bits
+            m.d.comb += idx.eq(self.i.data[self.idx_shift:])
+        else:
+            # log index : priority encode the msb
+            m.d.comb += idx.eq(self.i.data[:self.mant])
+            for msb in range(self.mant, self.iwidth):
+                with m.If(self.i.data[msb]):
+                    e = msb - self.mant + 1
+                    m.d.comb += idx.eq(Cat(self.i.data[msb-self.mant:msb], Const(e, self.idx_bits - self.mant)))
+
+        with m.If((~self.send) & ~self.i.ready):
+            m.d.sync += self.i.ready.eq(1)
+
+        with m.If(self.i.valid & self.i.ready):
+            m.d.sync += [
+                self.i.ready.eq(0),
+                self.level.eq(idx),
+                self.send.eq(1),
+                self.seg.eq(0),
+            ]
+
+        # the ROM data is held while the output is stalled
+        advance = Signal()
+        m.d.comb += [
+            advance.eq(self.o.ready | ~self.s1_valid),
+            rd.en.eq(advance),
+            rd.addr.eq(Cat(self.level, self.seg[:self.seg_bits])),
+            self.o.valid.eq(self.s1_valid),
+            self.o.data.eq(rd.data),
+        ]
+
+        with m.If(advance):
+            m.d.sync += self.s1_valid.eq(0)
+            with m.If(self.send):
+                m.d.sync += [
+                    self.s1_valid.eq(1),
+                    self.o.first.eq(self.seg == 0),
+                    self.o.last.eq(self.seg == self.end),
+                    self.seg.eq(self.seg + 1),
+                ]
+                with m.If(self.seg == self.end):
+                    m.d.sync += self.send.eq(0)
+
+        return m
+
 #
 #
 
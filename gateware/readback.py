@@ -0,0 +1,167 @@
+
+from amaranth import *
+
+from streams import Stream
+
+#
+#   Register bank.
+#
+#   Any packet arriving on 'i' is a read request. The reply is a packet on
+#   'o' holding the current value of each of the registers, in order.
+
+class Registers(Elaboratable):
+
+    def __init__(self, regs, width=32, name="Registers"):
+        assert regs
+        self.name = name
+        self.n = len(regs)
+        self.regs = Array([ Value.cast(r) for r in regs ])
+        self.i = Stream(layout=[("data", width)], name="i")
+        self.o = Stream(layout=[("data", width)], name="o")
+
+        self.idx = Signal(range(self.n + 1))
+        self.send = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        with m.If((~self.send) & ~self.i.ready):
+            m.d.sync += self.i.ready.eq(1)
+
+        with m.If(self.i.valid & self.i.ready & self.i.last):
+            m.d.sync += [
+                self.i.ready.eq(0),
+                self.send.eq(1),
+                self.idx.eq(0),
+            ]
+
+        with m.If(self.o.valid & self.o.ready):
+            m.d.sync += self.o.valid.eq(0)
+
+        with m.If(self.send & (self.o.ready | ~self.o.valid)):
+            with m.If(self.idx == self.n):
+                m.d.sync += self.send.eq(0)
+            with m.Else():
+                m.d.sync += [
+                    self.o.valid.eq(1),
+                    self.o.first.eq(self.idx == 0),
+                    self.o.last.eq(self.idx == (self.n - 1)),
+                    self.o.data.eq(self.regs[self.idx]),
+                    self.idx.eq(self.idx + 1),
+                ]
+
+        return m
+
+#
+#   Shift words from 'i' out on the SPI cipo line, MSB first.
+#
+#   SPI mode 0 : cipo changes on the falling edge of sck. Between words the
+#   MSB of the next word is presented without taking it from 'i'; the word
+#   is only taken when its first bit is clocked, so a transaction never
+#   consumes data it doesn't read. If there is no data waiting, zeros are
+#   sent.
+
+class SpiReadback(Elaboratable):
+
+    def __init__(self, width=32, name="SpiReadback"):
+        self.name = name
+        self.width = width
+        self.i = Stream(layout=[("data", width)], name="i")
+
+        # SPI pins
+        self.scs = Signal()
+        self.sck = Signal()
+        self.cipo = Signal()
+
+        self.shift = Signal(width)
+        # bits left in the shift register, 0 when between words
+        self.bits = Signal(range(width + 1))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # synchronise the pins to the sys clock
+        scs = Signal(3, reset=-1)
+        sck = Signal(3)
+        m.d.sync += [
+            scs.eq(Cat(self.scs, scs[:-1])),
+            sck.eq(Cat(self.sck, sck[:-1])),
+        ]
+
+        active = Signal()
+        sck_rise = Signal()
+        sck_fall = Signal()
+        m.d.comb += [
+            active.eq(~scs[1]),
+            sck_rise.eq(active & sck[1] & ~sck[2]),
+            sck_fall.eq(active & sck[2] & ~sck[1]),
+        ]
+
+        with m.If(self.bits == 0):
+            m.d.comb += self.cipo.eq(self.i.valid & self.i.data[-1])
+        with m.Else():
+            m.d.comb += self.cipo.eq(self.shift[-1])
+
+        m.d.comb += self.i.ready.eq(sck_rise & (self.bits == 0))
+
+        with m.If(~active):
+            m.d.sync += self.bits.eq(0)
+        with m.Elif(sck_rise & (self.bits == 0)):
+            m.d.sync += [
+                self.shift.eq(Mux(self.i.valid, self.i.data, 0)),
+                self.bits.eq(self.width),
+            ]
+        with m.Elif(sck_fall & (self.bits != 0)):
+            m.d.sync += [
+                self.shift.eq(self.shift << 1),
+                self.bits.eq(self.bits - 1),
+            ]
+
+        return m
+
+#
+#   Handshake counters for a list of (source, sink) Stream links.
+#
+#   For each link : transfers (valid & ready), stalls (valid & ~ready) and
+#   starved cycles (ready & ~valid). The counters wrap. A packet on 'ci'
+#   requests them all, sent as a packet on 'o' : 3 words per link, in the
+#   order of 'links'.
+
+class LinkStats(Elaboratable):
+
+    def __init__(self, links, width=32, name="LinkStats"):
+        assert links
+        self.name = name
+        self.links = [ (a, b) for a, b, *_ in links ]
+        self.names = [ f"{a.name}->{b.name}" for a, b in self.links ]
+
+        self.xfers = [ Signal(width, name=f"xfer{i}") for i in range(len(self.links)) ]
+        self.stalls = [ Signal(width, name=f"stall{i}") for i in range(len(self.links)) ]
+        self.starved = [ Signal(width, name=f"starved{i}") for i in range(len(self.links)) ]
+
+        regs = []
+        for counters in zip(self.xfers, self.stalls, self.starved):
+            regs += counters
+        self.regs = Registers(regs, width=width, name=f"{name}.regs")
+        self.ci = self.regs.i
+        self.o = self.regs.o
+
+        self.mods = [
+            self.regs,
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mods
+
+        for (a, b), xfer, stall, starved in zip(self.links, self.xfers, self.stalls, self.starved):
+            with m.If(a.valid & a.ready):
+                m.d.sync += xfer.eq(xfer + 1)
+            with m.If(a.valid & ~a.ready):
+                m.d.sync += stall.eq(stall + 1)
+            with m.If(a.ready & ~a.valid):
+                m.d.sync += starved.eq(starved + 1)
+
+        return m
+
+#   FIN
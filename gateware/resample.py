@@ -0,0 +1,311 @@
+
+import math
+
+from amaranth import *
+from amaranth.utils import bits_for
+from amaranth.lib.memory import Memory
+
+from streams import Stream
+from streams.ram import DualPortMemory
+
+from readback import Registers
+
+#
+#   Asynchronous sample rate converter, eg. 44.1kHz SPDIF to the local 48kHz.
+#
+#   Input samples are written to a history memory as they arrive, and output
+#   samples are made at the local rate, one every 'period >> rate' clocks,
+#   by interpolating the input at a fractional position 'pos'. Each output
+#   moves 'pos' on by 'step', the ratio of the input to the output rate.
+#
+#   The filter is a windowed sinc of 'taps' input samples, tabulated in a ROM
+#   at 'phases' positions per input sample. The output is interpolated
+#   linearly between the two nearest phases. One multiplier is shared by
+#   every tap, phase and channel : 4 * taps MAC cycles, plus a few.
+#
+#   The rate is measured by counting the input samples over a window of
+#   2^window_bits outputs, so the nominal step is count / 2^window_bits.
+#   'err', how far 'pos' is from 'delay' samples behind the input, is taken
+#   as each input sample arrives and added to the step >> gain_bits, so the
+#   latency stays at 'delay' input samples. The converter locks after two
+#   windows with input, and outputs silence until then. If 'err' goes past
+#   'slack' samples it loses lock and counts a slip.
+#
+#   A packet on 'ci' requests the stats, sent as a packet on 'ro' : count,
+#   err, slips, locked. See fs_in().
+
+class Resample(Elaboratable):
+
+    def __init__(self, layout, period, rates=1, taps=16, phases=128, cwidth=18, cutoff=0.9,
+                 window_bits=16, gain_bits=16, frac=24, depth=64, slack=6, width=32, name="Resample"):
+        assert len(layout) == 2
+        assert taps == (1 << bits_for(taps - 1))
+        assert phases == (1 << bits_for(phases - 1))
+        assert frac >= window_bits
+        self.name = name
+        self.layout = layout
+        self.period = period
+        self.taps = taps
+        self.phases = phases
+        self.cwidth = cwidth
+        self.cutoff = cutoff
+        self.window_bits = window_bits
+        self.gain_bits = gain_bits
+        self.frac = frac
+        self.delay = (taps // 2) + slack + 2
+        self.slack = slack
+        iwidth = layout[0][1]
+        self.iwidth = iwidth
+
+        self.i = Stream(layout=layout, name="i")
+        self.o = Stream(layout=layout, name="o")
+
+        # input history, both channels in one word
+        self.abits = bits_for(depth - 1)
+        assert depth == (1 << self.abits)
+        assert depth >= (self.delay + slack + (taps // 2) + 2)
+        self.mem = DualPortMemory(width=2 * iwidth, depth=depth)
+        self.mem.dot_dont_expand = True
+
+        # coefficients : a row of 'taps' for each phase, plus one
+        self.tbits = bits_for(taps - 1)
+        self.pbits = bits_for(phases - 1)
+        self.point = cwidth - 2
+        self.rom = Memory(shape=signed(cwidth), depth=(phases + 1) << self.tbits, init=self.table())
+
+        # local rate
+        self.rate = Signal(range(rates))
+        self.timer = Signal(range(period))
+        self.tick = Signal()
+        self.due = Signal()
+
+        # position, in input samples with 'frac' fractional bits
+        self.wptr = Signal(self.abits)
+        self.pos = Signal(self.abits + frac)
+        self.step = Signal(frac + 2)
+        self.nominal = Signal(frac + 2)
+        self.err = Signal(signed(self.abits + frac + 1))
+
+        # rate measurement
+        self.window = Signal(window_bits)
+        self.count = Signal(window_bits + 2)
+        self.measured = Signal(window_bits + 2)
+        self.primed = Signal()
+        self.locked = Signal()
+        self.slips = Signal(width)
+
+        # MAC sequence
+        self.base = Signal(self.abits)
+        self.phase = Signal(self.pbits)
+        self.lerp = Signal(frac - self.pbits)
+        self.chan = Signal()
+        self.half = Signal()
+        self.tap = Signal(self.tbits)
+
+        acc_width = iwidth + cwidth + self.tbits + 1
+        self.ma = Signal(signed(iwidth + 3))
+        self.mb = Signal(signed(max(cwidth, len(self.lerp) + 1)))
+        self.prod = Signal(signed(len(self.ma) + len(self.mb)))
+        self.acc = Signal(signed(acc_width))
+        # filter output for each channel, at phase and phase + 1
+        self.y = Array([ Array([ Signal(signed(iwidth + 2), name=f"y{c}_{h}") for h in range(2) ]) for c in range(2) ])
+
+        # pipeline flags : Cat(valid, first tap, last tap, half, chan)
+        self.s1 = Signal(5)
+        self.s2 = Signal(5)
+        self.s3 = Signal(5)
+
+        self.regs = Registers([ self.measured, self.err, self.slips, self.locked ], width=width, name=f"{name}.regs")
+        self.ci = self.regs.i
+        self.ro = self.regs.o
+
+        self.mods = [
+            self.mem,
+            self.regs,
+        ]
+
+    def table(self):
+        # windowed sinc, each row normalised to unity gain
+        half = self.taps // 2
+        def h(t):
+            x = self.cutoff * t
+            s = 1.0 if x == 0 else math.sin(math.pi * x) / (math.pi * x)
+            w = 0.42 + (0.5 * math.cos(math.pi * t / half)) + (0.08 * math.cos(2 * math.pi * t / half))
+            return s * w if abs(t) < half else 0.0
+        t = []
+        for p in range(self.phases + 1):
+            # tap k is input sample 'base - k', base = int(pos) + taps / 2
+            row = [ h((p / self.phases) - half + k) for k in range(self.taps) ]
+            gain = sum(row)
+            t += [ int(round(c * (1 << self.point) / gain)) for c in row ]
+        return t
+
+    def fs_in(self, count, fs=48000):
+        # convert a 'count' reading to the input sample rate
+        return count * fs / (1 << self.window_bits)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mods
+        m.submodules.rom = self.rom
+        rd = self.rom.read_port()
+
+        fields = [ name for name, _ in self.layout ]
+        iwidth = self.iwidth
+
+        # input : never stalls the remote source
+        m.d.comb += [
+            self.i.ready.eq(1),
+            self.mem.wr.addr.eq(self.wptr),
+            self.mem.wr.data.eq(Cat(*[ getattr(self.i, f) for f in fields ])),
+            self.mem.wr.en.eq(self.i.valid),
+        ]
+
+        # distance from 'pos' to the input, less the delay
+        dist = Signal(self.abits + self.frac)
+        m.d.comb += dist.eq(Cat(Const(0, self.frac), self.wptr) - self.pos)
+        with m.If(self.i.valid):
+            m.d.sync += [
+                self.wptr.eq(self.wptr + 1),
+                self.count.eq(self.count + 1),
+                self.err.eq(dist - (self.delay << self.frac)),
+            ]
+
+        m.d.comb += self.step.eq(self.nominal + (self.err >> self.gain_bits))
+
+        # local rate
+        m.d.sync += self.timer.eq(self.timer + 1)
+        with m.If(self.timer == ((self.period >> self.rate) - 1)):
+            m.d.sync += self.timer.eq(0)
+        m.d.comb += self.tick.eq(self.timer == 0)
+        with m.If(self.tick):
+            m.d.sync += self.due.eq(1)
+
+        # rate measurement and lock
+        with m.If(self.tick):
+            m.d.sync += self.window.eq(self.window + 1)
+            with m.If(self.window == ((1 << self.window_bits) - 1)):
+                total = self.count + self.i.valid
+                m.d.sync += [
+                    self.measured.eq(total),
+                    self.nominal.eq(total << (self.frac - self.window_bits)),
+                    self.count.eq(0),
+                    self.primed.eq(total != 0),
+                ]
+                with m.If(total == 0):
+                    m.d.sync += self.locked.eq(0)
+                with m.Elif(self.primed & ~self.locked):
+                    m.d.sync += [
+                        self.locked.eq(1),
+                        self.pos.eq(Cat(Const(0, self.frac), self.wptr - self.delay)),
+                        self.err.eq(0),
+                    ]
+
+        with m.If(self.locked & ((self.err > (self.slack << self.frac)) | (self.err < -(self.slack << self.frac)))):
+            m.d.sync += [
+                self.locked.eq(0),
+                self.slips.eq(self.slips + 1),
+            ]
+
+        # MAC pipeline : read, multiply, accumulate, store
+        data = Signal(2 * iwidth)
+        m.d.comb += [
+            self.mem.rd.addr.eq(self.base - self.tap),
+            rd.addr.eq(Cat(self.tap, self.phase + self.half)),
+            data.eq(self.mem.rd.data),
+        ]
+        sample = Mux(self.s1[4], data[iwidth:], data[:iwidth]).as_signed()
+
+        m.d.sync += [
+            self.s2.eq(self.s1),
+            self.s3.eq(self.s2),
+            self.prod.eq(self.ma * self.mb),
+        ]
+        with m.If(self.s2[0]):
+            m.d.sync += self.acc.eq(Mux(self.s2[1], 0, self.acc) + self.prod)
+        with m.If(self.s3[0] & self.s3[2]):
+            m.d.sync += self.y[self.s3[4]][self.s3[3]].eq(self.acc >> self.point)
+
+        busy = Signal()
+        m.d.comb += busy.eq(self.s1[0] | self.s2[0] | self.s3[0])
+
+        with m.If(self.o.valid & self.o.ready):
+            m.d.sync += self.o.valid.eq(0)
+
+        top = (1 << (iwidth - 1)) - 1
+        mixed = Signal(signed(iwidth + 3))
+        m.d.comb += mixed.eq(self.y[self.chan][0] + (self.prod >> len(self.lerp)))
+
+        with m.FSM(reset="IDLE"):
+
+            with m.State("IDLE"):
+                with m.If(self.due & ~self.o.valid):
+                    m.d.sync += self.due.eq(0)
+                    with m.If(~self.locked):
+                        # silence
+                        m.d.sync += [ getattr(self.o, f).eq(0) for f in fields ]
+                        m.d.sync += self.o.valid.eq(1)
+                    with m.Else():
+                        m.d.sync += [
+                            self.base.eq(self.pos[self.frac:] + (self.taps // 2)),
+                            self.phase.eq(self.pos[self.frac - self.pbits:self.frac]),
+                            self.lerp.eq(self.pos[:self.frac - self.pbits]),
+                            self.pos.eq(self.pos + self.step),
+                            self.chan.eq(0),
+                            self.half.eq(0),
+                            self.tap.eq(0),
+                        ]
+                        m.next = "RUN"
+
+            with m.State("RUN"):
+                m.d.comb += [
+                    self.ma.eq(sample),
+                    self.mb.eq(rd.data),
+                ]
+                end = self.tap == (self.taps - 1)
+                m.d.sync += [
+                    self.s1.eq(Cat(1, self.tap == 0, end, self.half, self.chan)),
+                    self.tap.eq(self.tap + 1),
+                ]
+                with m.If(end):
+                    m.d.sync += self.half.eq(~self.half)
+                    with m.If(self.half):
+                        m.d.sync += self.chan.eq(1)
+                        with m.If(self.chan):
+                            m.next = "DRAIN"
+
+            with m.State("DRAIN"):
+                # the last taps are still in the pipeline : keep the operands
+                m.d.comb += [
+                    self.ma.eq(sample),
+                    self.mb.eq(rd.data),
+                ]
+                m.d.sync += self.s1.eq(0)
+                with m.If(~busy):
+                    m.d.sync += self.chan.eq(0)
+                    m.next = "MUL"
+
+            # interpolate between the phases : y0 + ((y1 - y0) * lerp)
+            with m.State("MUL"):
+                m.d.comb += [
+                    self.ma.eq(self.y[self.chan][1] - self.y[self.chan][0]),
+                    self.mb.eq(self.lerp),
+                ]
+                m.next = "ADD"
+
+            with m.State("ADD"):
+                clipped = Mux(mixed > top, top, Mux(mixed < -(top + 1), -(top + 1), mixed))
+                with m.Switch(self.chan):
+                    for idx, f in enumerate(fields):
+                        with m.Case(idx):
+                            m.d.sync += getattr(self.o, f).eq(clipped)
+                m.d.sync += self.chan.eq(1)
+                with m.If(self.chan):
+                    m.d.sync += self.o.valid.eq(1)
+                    m.next = "IDLE"
+                with m.Else():
+                    m.next = "MUL"
+
+        return m
+
+#   FIN
@@ -0,0 +1,25 @@
+
+from amaranth import *
+
+#
+#   Watch Streams without affecting them.
+#
+#   tap() gives the statements for the parent's elaborate : on each transfer
+#   of the stream 's', 'strobe[idx]' is set with 'sample[idx]' holding
+#   'data'. The owner reads 'strobe' and 'sample'.
+
+class Taps:
+
+    def __init__(self, n, shape, prefix=""):
+        self.n = n
+        self.strobe = [ Signal(name=f"{prefix}strobe{i}") for i in range(n) ]
+        self.sample = [ Signal(shape, name=f"{prefix}sample{i}") for i in range(n) ]
+
+    def tap(self, idx, s, data):
+        # watch the stream 's', sampling 'data' on each transfer
+        return [
+            self.strobe[idx].eq(s.valid & s.ready),
+            self.sample[idx].eq(data),
+        ]
+
+#   FIN
@@ -0,0 +1,129 @@
+
+from amaranth import *
+from amaranth.utils import bits_for
+
+from streams import Stream
+
+from readback import Registers
+from tap import Taps
+
+#
+#   Interleave several channels into one packet per frame.
+#
+#   tap() watches a Stream without affecting it : each transfer latches the
+#   sample for that channel. Each 'start' strobe sends the latest sample of
+#   every channel as a packet on 'o', in channel order.
+
+class Packetizer(Elaboratable):
+
+    def __init__(self, n, width, name="Packetizer"):
+        self.name = name
+        self.n = n
+        self.start = Signal()
+
+        self.taps = Taps(n, width)
+        self.strobe = self.taps.strobe
+        self.sample = self.taps.sample
+        self.tap = self.taps.tap
+        self.latched = [ Signal(width, name=f"latched{i}") for i in range(n) ]
+
+        self.regs = Registers(self.latched, width=width, name=f"{name}.regs")
+        self.o = self.regs.o
+
+        self.mods = [
+            self.regs,
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mods
+
+        for strobe, sample, latched in zip(self.strobe, self.sample, self.latched):
+            with m.If(strobe):
+                m.d.sync += latched.eq(sample)
+
+        m.d.comb += [
+            self.regs.i.valid.eq(self.start),
+            self.regs.i.first.eq(1),
+            self.regs.i.last.eq(1),
+        ]
+
+        return m
+
+#
+#   TDM serial output : 'slots' slots of 'width' bits per frame.
+#
+#   Each 'en' strobe toggles sck, so 'en' must run at 2 * slots * width * Fs.
+#   Data changes on the falling edge of sck, MSB first, samples left
+#   justified in the slot. ws is high for one bit before the first bit of
+#   slot 0 (DSP mode A).
+#
+#   Each packet on 'i' holds the samples of the next frame, slot 0 first.
+#   It is requested by 'frame', strobed at the start of the last slot, and
+#   must arrive before the end of that slot. Slots without a sample are
+#   zero.
+
+class TdmOutput(Elaboratable):
+
+    def __init__(self, slots=8, width=32, iwidth=16, name="TdmOutput"):
+        assert iwidth <= width
+        assert width == (1 << bits_for(width - 1))
+        self.name = name
+        self.slots = slots
+        self.width = width
+        self.iwidth = iwidth
+        self.i = Stream(layout=[("data", iwidth)], name="i")
+
+        self.en = Signal()
+        self.frame = Signal()
+
+        # pins
+        self.sck = Signal()
+        self.ws = Signal()
+        self.sd = Signal()
+
+        self.bits = slots * width
+        self.count = Signal(range(self.bits))
+        self.words = Array([ Signal(iwidth, name=f"word{i}") for i in range(slots) ])
+        self.idx = Signal(range(slots + 1))
+        self.shift = Signal(width)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # input : one word per slot
+        m.d.comb += self.i.ready.eq(1)
+        with m.If(self.i.valid):
+            idx = Mux(self.i.first, 0, self.idx)
+            with m.If(idx < self.slots):
+                m.d.sync += self.words[idx].eq(self.i.data)
+            m.d.sync += self.idx.eq(idx + 1)
+
+        with m.If(self.en):
+            m.d.sync += self.sck.eq(~self.sck)
+
+            with m.If(self.sck):
+                # falling edge : the next bit
+                nxt = Mux(self.count == (self.bits - 1), 0, self.count + 1)
+                slot = nxt[bits_for(self.width - 1):]
+                m.d.sync += [
+                    self.count.eq(nxt),
+                    self.ws.eq(nxt == (self.bits - 1)),
+                ]
+                with m.If(nxt[:bits_for(self.width - 1)] == 0):
+                    word = Cat(Const(0, self.width - self.iwidth), self.words[slot])
+                    m.d.sync += [
+                        self.sd.eq(word[-1]),
+                        self.shift.eq(word << 1),
+                    ]
+                    with m.If(nxt == ((self.slots - 1) * self.width)):
+                        m.d.comb += self.frame.eq(1)
+                with m.Else():
+                    m.d.sync += [
+                        self.sd.eq(self.shift[-1]),
+                        self.shift.eq(self.shift << 1),
+                    ]
+
+        return m
+
+#   FIN
@@ -0,0 +1,97 @@
+#!/bin/env python
+
+import sys
+import math
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from ppm import LutBarGraph
+
+#
+#   Check that the LED segments of a log domain bar graph light at the
+#   thresholds, in dBFS, that they were given.
+
+def db(level):
+    return 20 * math.log10(level / 0x8000)
+
+def log_level(dbfs, frac):
+    # LogPPM output for a peak of 'dbfs'
+    return int(math.log2(0x8000 * (10 ** (dbfs / 20))) * (1 << frac))
+
+def sim_bargraph(m, thresholds, frac):
+    print("test bargraph", m.n, "segments")
+    sim = Simulator(m)
+
+    sink = SinkSim(m.o)
+    src = SourceSim(m.i)
+
+    polls = [ sink, src ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    # each threshold, 0.5dB (more than one LUT step) either side
+    levels = []
+    for t in thresholds[1:]:
+        levels += [ (db(t) - 0.5, t) ]
+        if t != thresholds[-1]:
+            levels += [ (db(t) + 0.5, t) ]
+
+    def proc():
+
+        t = 10
+        for dbfs, _ in levels:
+            src.push(t, data=log_level(dbfs, frac))
+            t += 20
+
+        yield from tick(10)
+
+        while not src.done():
+            yield from tick(1)
+
+        yield from tick(40)
+
+        packets = sink.get_data("data")
+        assert len(packets) == len(levels), (len(packets), len(levels))
+        for (dbfs, thresh), segs in zip(levels, packets):
+            assert len(segs) == m.n, segs
+            # segment k covers thresholds[k] to thresholds[k+1]
+            k = thresholds.index(thresh)
+            if dbfs > db(thresh):
+                # every segment below is full on, any above is off
+                assert segs[:k] == ([ m.max ] * k), (dbfs, segs)
+                assert segs[k] > 0, (dbfs, segs)
+                assert segs[k+1:] == ([ 0 ] * (m.n - k - 1)), (dbfs, segs)
+            else:
+                assert segs[:k-1] == ([ m.max ] * (k - 1)), (dbfs, segs)
+                assert segs[k-1] < m.max, (dbfs, segs)
+                assert segs[k:] == ([ 0 ] * (m.n - k)), (dbfs, segs)
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/bargraph.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    # as the Meter, with log=True : 16-bit LogPPM output, 12 fractional bits
+    frac = 12
+    thresholds = [ 0x10, 0x80, 0x200, 0x800, 0x1000, 0x2000, 0x4000, 0x7fff  ]
+    log_thresholds = [ int(math.log2(t) * (1 << frac)) for t in thresholds ]
+    dut = LutBarGraph(iwidth=16, owidth=8, thresholds=log_thresholds, log_bits=8)
+    sim_bargraph(dut, thresholds, frac)
+
+#   FIN
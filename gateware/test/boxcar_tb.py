@@ -0,0 +1,92 @@
+#!/bin/env python
+
+import sys
+import random
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from ppm import PipelinedBoxcar
+
+#
+#
+
+def sim_boxcar(m, depth, chans):
+    print("test boxcar", depth, chans)
+    sim = Simulator(m)
+
+    sink = SinkSim(m.o)
+    src = SourceSim(m.i)
+
+    polls = [ sink, src ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    def proc():
+
+        random.seed(chans)
+        data = [ (random.randint(0, 0x7fff), random.randrange(chans)) for i in range(200) ]
+
+        # back to back, to check one sample per clock
+        t = 10
+        for d, c in data:
+            if chans > 1:
+                src.push(t, data=d, chan=c)
+            else:
+                src.push(t, data=d)
+            t += 1
+
+        yield from tick(10)
+
+        while not src.done():
+            yield from tick(1)
+
+        yield from tick(10)
+
+        shift = depth.bit_length() - 1
+        history = [ [] for i in range(chans) ]
+        expect = []
+        for d, c in data:
+            history[c].append(d)
+            expect.append((sum(history[c][-depth:]) >> shift, c))
+
+        d = sink.get_data()[0]
+        assert len(d) == len(expect), (len(d), len(expect))
+        for x, (e, c) in zip(d, expect):
+            assert x['data'] == e, (x, e)
+            if chans > 1:
+                assert x['chan'] == c, (x, c)
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/boxcar.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        dut = PipelinedBoxcar(width=16, depth=16)
+        sim_boxcar(dut, 16, 1)
+        dut = PipelinedBoxcar(width=16, depth=16, chans=5)
+        sim_boxcar(dut, 16, 5)
+
+    from streams import dot
+    dot_path = "/tmp/wifi.dot"
+    png_path = "test.png"
+    dot.graph(dut, dot_path, png_path)
+
+#   FIN
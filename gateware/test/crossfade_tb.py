@@ -0,0 +1,168 @@
+#!/bin/env python
+
+import sys
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from crossfade import Crossfade
+
+#
+#
+
+def sim_crossfade(m, rate, ramp, dead=False):
+    print("test crossfade, rate", rate, *([ "dead input" ] if dead else []))
+    sim = Simulator(m)
+
+    sink = SinkSim(m.o)
+
+    polls = [ sink ]
+
+    # the level of each channel, as seen through the Select of each path,
+    # None for an input that has no samples
+    levels = [ 1000, -2000, 3000, 30000, -32768 ]
+    if dead:
+        levels[1] = None
+    period = 20
+
+    info = {
+        'ck' : 0,
+    }
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+            # each path : one sample per period, held until taken
+            for s, path_select in zip(m.i, m.path_select):
+                if (yield s.valid) and (yield s.ready):
+                    yield s.valid.eq(0)
+                level = levels[(yield path_select)]
+                if (info['ck'] == 0) and (level is not None):
+                    yield s.left.eq(level)
+                    yield s.right.eq(level // 2)
+                    yield s.valid.eq(1)
+            info['ck'] = (info['ck'] + 1) % period
+
+    def expect(old, new):
+        # one sample of each gain, from 0 up to the last step below 1
+        step = m.step >> rate
+        fade = []
+        gain = 0
+        while gain < (1 << m.gbits):
+            fade.append(old + (((new - old) * gain) >> m.gbits))
+            gain += step
+        return fade
+
+    def check(d, field, old, new, scale=1):
+        # the old level, then the ramp, then the new level
+        d = signed(d, field)
+        fade = expect(old // scale, new // scale)
+        while d and (d[0] == fade[0]):
+            d = d[1:]
+        assert d[:len(fade)-1] == fade[1:], (d[:len(fade)], fade)
+        d = d[len(fade)-1:]
+        assert d and (d == ([ new // scale ] * len(d))), d
+
+    def signed(d, field):
+        d = [ x[field] for x in d ]
+        return [ x - 0x10000 if x & 0x8000 else x for x in d ]
+
+    def proc_dead():
+        fade = (ramp << rate) * period
+
+        # to the dead input : a fade to silence, then nothing
+        n = len(sink.get_data()[0])
+        yield m.select.eq(1)
+        yield from tick(fade + (40 * period))
+        assert (yield m.channel) == 1
+        assert not (yield m.fading)
+        d = signed(sink.get_data()[0][n:], "left")
+        ramp_down = expect(levels[0], 0)
+        while d and (d[0] == ramp_down[0]):
+            d = d[1:]
+        assert d == ramp_down[1:], (d, ramp_down)
+
+        # and back again, from silence
+        n = len(sink.get_data()[0])
+        yield m.select.eq(0)
+        yield from tick(fade + (40 * period))
+        assert (yield m.channel) == 0
+        check(sink.get_data()[0][n:], "left", 0, levels[0])
+
+        # change channel during a fade, then back : the fade is aborted
+        n = len(sink.get_data()[0])
+        yield m.select.eq(2)
+        yield from tick(3 * period)
+        assert (yield m.fading)
+        yield m.select.eq(0)
+        yield from tick(fade + (40 * period))
+        assert (yield m.channel) == 0
+        assert not (yield m.fading)
+        d = signed(sink.get_data()[0][n:], "left")
+        assert d[-20:] == ([ levels[0] ] * 20), d
+
+        # and through the dead input to another
+        n = len(sink.get_data()[0])
+        yield m.select.eq(1)
+        yield from tick(3 * period)
+        yield m.select.eq(2)
+        yield from tick((2 * fade) + (40 * period))
+        assert (yield m.channel) == 2
+        d = signed(sink.get_data()[0][n:], "left")
+        assert d[-20:] == ([ levels[2] ] * 20), d
+
+    def proc():
+
+        yield m.rate.eq(rate)
+        yield from tick(20 * period)
+
+        assert (yield m.channel) == 0
+        n = len(sink.get_data()[0])
+
+        if dead:
+            yield from proc_dead()
+            return
+
+        for chan in [ 3, 1 ]:
+            old = levels[(yield m.channel)]
+            new = levels[chan]
+            yield m.select.eq(chan)
+            yield from tick((ramp << rate) * period + (40 * period))
+
+            assert (yield m.channel) == chan, chan
+            assert not (yield m.fading)
+
+            d = sink.get_data()[0]
+            check(d[n:], "left", old, new)
+            check(d[n:], "right", old, new, 2)
+            n = len(d)
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/crossfade.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        layout = [("left", 16), ("right", 16)]
+        ramp = 16
+        for rate in range(3):
+            dut = Crossfade(layout=layout, chans=5, ramp=ramp, period=20, rates=3)
+            sim_crossfade(dut, rate, ramp)
+        dut = Crossfade(layout=layout, chans=5, ramp=ramp, period=20, rates=3)
+        sim_crossfade(dut, 0, ramp, dead=True)
+
+#   FIN
@@ -0,0 +1,94 @@
+#!/bin/env python
+
+import sys
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from decouple import DecoupledTee
+
+#
+#
+
+def sim_decouple(m, depth):
+    print("test decouple, counters", m.counters)
+    sim = Simulator(m)
+
+    sinks = [ SinkSim(o) for o in m.o ]
+    src = SourceSim(m.i)
+
+    # the last output is stalled until the input has all been sent
+    stalled = len(m.o) - 1
+    polls = sinks[:stalled] + [ src ]
+
+    if m.counters:
+        ctl = SourceSim(m.ci)
+        reply = SinkSim(m.ro)
+        polls += [ ctl, reply ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    def proc():
+
+        data = list(range(100, 150))
+        t = 10
+        for d in data:
+            src.push(t, data=d)
+            t += 1
+
+        yield from tick(10)
+
+        while not src.done():
+            yield from tick(1)
+
+        # release the stalled output
+        polls.append(sinks[stalled])
+        yield from tick(20)
+
+        # the critical outputs get every sample
+        for k in m.critical:
+            d = sinks[k].get_data("data")[0]
+            assert d == data, (k, d)
+
+        # the stalled output gets the first 'depth', the rest are dropped
+        d = sinks[stalled].get_data("data")[0]
+        assert d == data[:depth], d
+
+        if not m.counters:
+            return
+
+        ctl.push(0, data=0, first=1, last=1)
+        yield from tick(20)
+        drops = reply.get_data("data")[0]
+        expect = [ 0 ] * len(m.o)
+        expect[stalled] = len(data) - depth
+        assert drops == expect, (drops, expect)
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/decouple.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        depth = 4
+        for counters in [ True, False ]:
+            dut = DecoupledTee(layout=[("data", 16)], n=3, critical=[0, 1], depth=depth, counters=counters)
+            sim_decouple(dut, depth)
+
+#   FIN
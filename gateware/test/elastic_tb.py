@@ -0,0 +1,97 @@
+#!/bin/env python
+
+import sys
+import math
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from elastic import Elastic
+
+#
+#
+
+def sim_elastic(m, ratio, samples):
+    print("test elastic, ratio", ratio)
+    sim = Simulator(m)
+
+    sink = SinkSim(m.o)
+    src = SourceSim(m.i)
+    ctl = SourceSim(m.ci)
+    reply = SinkSim(m.ro)
+
+    polls = [ sink, src, ctl, reply ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    def proc():
+
+        # the remote clock is 'ratio' times the local rate :
+        # a sine on the left, a count on the right
+        for n in range(samples):
+            t = 10 + int(n * m.period / ratio)
+            left = int(100000 * math.sin(2 * math.pi * n / 40)) & 0xfffff
+            src.push(t, left=left, right=n)
+
+        yield from tick(10)
+
+        while not src.done():
+            yield from tick(1)
+
+        ctl.push(0, data=0, first=1, last=1)
+        yield from tick(20)
+
+        delta, fill, drops, repeats, overflows = reply.get_data("data")[0]
+        assert overflows == 0, overflows
+
+        # the drift, to within one count per window
+        ppm = m.ppm(delta)
+        expect = (ratio - 1) * 1e6
+        assert abs(ppm - expect) <= (1e6 / (1 << m.window_bits)), (ppm, expect)
+
+        # a fast source drops samples, a slow one repeats them
+        d = sink.get_data("right")[0]
+        steps = set([ b - a for a, b in zip(d, d[1:]) ])
+        if ratio > 1:
+            assert drops and not repeats, (drops, repeats)
+            assert steps == set([ 1, 2 ]), steps
+        else:
+            assert repeats and not drops, (drops, repeats)
+            assert steps == set([ 0, 1 ]), steps
+
+        # only next to a zero crossing of the left channel
+        left = sink.get_data("left")[0]
+        left = [ x - 0x100000 if x & 0x80000 else x for x in left ]
+        for i, (a, b) in enumerate(zip(d, d[1:])):
+            if (b - a) != 1:
+                near = left[i:i+3]
+                assert (0 in near) or (len(set([ x < 0 for x in near ])) > 1), (i, near)
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/elastic.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        layout = [("left", 20), ("right", 20)]
+        for ratio in [ 1.01, 0.99 ]:
+            dut = Elastic(layout=layout, period=50, depth=16, window_bits=8)
+            sim_elastic(dut, ratio, 1500)
+
+#   FIN
@@ -0,0 +1,157 @@
+#!/bin/env python
+
+import sys
+import math
+import cmath
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from ppm import KWeight, Loudness
+
+#
+#   Gain squared of the K-weighting, from the float coefficients
+
+def kgain(fs, freq):
+    z = cmath.exp(-2j * math.pi * freq / fs)
+    g = 1
+    for b0, b1, b2, a1, a2 in [ KWeight.shelf(fs), KWeight.rlb(fs) ]:
+        g *= (b0 + (b1 * z) + (b2 * z * z)) / (1 + (a1 * z) + (a2 * z * z))
+    return abs(g) ** 2
+
+def sine(n, fs, freq, amp, phase=0):
+    return int(round(amp * math.sin((2 * math.pi * freq * n / fs) + phase)))
+
+#
+#
+
+def sim_kweight(m, fs):
+    print("test kweight")
+    sim = Simulator(m)
+
+    sink = SinkSim(m.o)
+    src = SourceSim(m.i)
+
+    polls = [ sink, src ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    mask = (1 << len(m.i.left)) - 1
+
+    def send(data):
+        for left, right in data:
+            src.push(0, left=left & mask, right=right & mask)
+        while not src.done():
+            yield from tick(1)
+        yield from tick(m.steps * 8)
+
+    def proc():
+
+        # 1kHz at -20dBFS, in quadrature on the right
+        freq, amp = 1000, 0x8000 / 10
+        settle, samples = 500, 960
+        yield from send([ (sine(n, fs, freq, amp), sine(n, fs, freq, amp, math.pi / 2)) for n in range(settle + samples) ])
+
+        power = sink.get_data("data")[0]
+        assert len(power) == (settle + samples), len(power)
+        ms = sum(power[settle:]) / samples
+        # the K-weighting is +0.69dB at 1kHz
+        gain = kgain(fs, freq)
+        assert abs((10 * math.log10(gain)) - 0.69) < 0.02, gain
+        expect = 2 * (amp * amp / 2) * gain
+        assert abs(ms - expect) < (expect * 0.001), (ms, expect)
+
+        # DC is blocked by the RLB high pass
+        sink.packets = [ [] ]
+        yield from send([ (10000, -10000) ] * 3000)
+        power = sink.get_data("data")[0]
+        assert power[0] > 0, power[0]
+        assert power[-500:] == ([ 0 ] * 500), power[-500:]
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/kweight.vcd", traces=[]):
+        sim.run()
+
+#
+#   The momentary loudness of a sine.
+#
+#   Run at a low 'fs', as the window is 400ms of samples : the short-term
+#   (3s) window is not checked.
+
+def sim_loudness(m, fs):
+    print("test loudness, fs", fs)
+    sim = Simulator(m)
+
+    src = SourceSim(m.i)
+    ctl = SourceSim(m.ci)
+    reply = SinkSim(m.o)
+
+    polls = [ src, ctl, reply ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    def read():
+        ctl.push(0, data=0, first=1, last=1)
+        yield from tick(20)
+        return reply.get_data("data")[-1]
+
+    mask = (1 << len(m.i.left)) - 1
+
+    def proc():
+
+        momentary, short_term = yield from read()
+        assert m.lufs(momentary, 0) is None, momentary
+
+        # -20dBFS on both channels, for 500ms
+        freq, amp = 1000, 0x8000 / 10
+        for n in range(fs // 2):
+            v = sine(n, fs, freq, amp) & mask
+            src.push(0, left=v, right=v)
+        while not src.done():
+            yield from tick(1)
+        yield from tick(200)
+
+        momentary, short_term = yield from read()
+        # BS.1770 : -0.691 + 10 log10(sum of mean squares)
+        expect = -0.691 + (10 * math.log10(2 * 0.5 * (0.1 ** 2) * kgain(fs, freq)))
+        lufs = m.lufs(momentary, 0)
+        assert abs(lufs - expect) < 0.05, (lufs, expect)
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/loudness.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    layout = [("left", 16), ("right", 16)]
+    if do_all:
+        fs = 48000
+        dut = KWeight(layout=layout, fs=fs)
+        sim_kweight(dut, fs)
+    if do_all:
+        fs = 8000
+        dut = Loudness(layout=layout, fs=fs)
+        sim_loudness(dut, fs)
+
+#   FIN
@@ -0,0 +1,108 @@
+#!/bin/env python
+
+import sys
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from readback import Registers, SpiReadback
+
+#
+#   A register bank, read back over SPI
+
+class Readback(Elaboratable):
+
+    def __init__(self, values, width=32):
+        self.values = values
+        self.regs = Registers([ Const(v, width) for v in values ], width=width)
+        self.spi = SpiReadback(width=width)
+        self.ci = self.regs.i
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.regs = self.regs
+        m.submodules.spi = self.spi
+        m.d.comb += Stream.connect(self.regs.o, self.spi.i)
+        return m
+
+#
+#
+
+def sim_readback(m):
+    print("test readback")
+    sim = Simulator(m)
+    spi = m.spi
+
+    ctl = SourceSim(m.ci)
+
+    polls = [ ctl ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    # sys clocks per half period of sck
+    half = 8
+
+    def transfer(words):
+        # SPI mode 0 : sck idles low, cipo is sampled on the rising edge
+        yield spi.scs.eq(0)
+        yield from tick(half)
+        data = []
+        for w in range(words):
+            d = 0
+            for bit in range(spi.width):
+                d = (d << 1) | (yield spi.cipo)
+                yield spi.sck.eq(1)
+                yield from tick(half)
+                yield spi.sck.eq(0)
+                yield from tick(half)
+            data.append(d)
+        yield spi.scs.eq(1)
+        yield from tick(half)
+        return data
+
+    def proc():
+
+        yield spi.scs.eq(1)
+        yield from tick(10)
+
+        # nothing to read : zeros
+        data = yield from transfer(1)
+        assert data == [ 0 ], data
+
+        # request the registers
+        ctl.push(0, data=0, first=1, last=1)
+        yield from tick(20)
+
+        # read the first, then the rest in another transaction
+        data = yield from transfer(1)
+        assert data == m.values[:1], [ hex(d) for d in data ]
+        data = yield from transfer(len(m.values))
+        expect = m.values[1:] + [ 0 ]
+        assert data == expect, [ hex(d) for d in data ]
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/readback.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        dut = Readback([ 0x80000001, 0x12345678, 0xcafe ])
+        sim_readback(dut)
+
+#   FIN
@@ -0,0 +1,108 @@
+#!/bin/env python
+
+import sys
+import math
+
+import numpy as np
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from resample import Resample
+
+#
+#
+
+def sim_resample(m, fs_in, outputs, fs=48000, freq=1000):
+    print("test resample", fs_in, "to", fs)
+    sim = Simulator(m)
+
+    sink = SinkSim(m.o)
+    src = SourceSim(m.i)
+    ctl = SourceSim(m.ci)
+    reply = SinkSim(m.ro)
+
+    polls = [ sink, src, ctl, reply ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    amps = [ 0.5, 0.25 ]
+
+    def proc():
+
+        # a sine on the left, a cosine on the right, at 'fs_in'
+        full = 1 << (m.iwidth - 1)
+        period = m.period * fs / fs_in
+        n = 0
+        while (n * period) < (outputs * m.period):
+            w = 2 * math.pi * freq * n / fs_in
+            left = int(amps[0] * full * math.sin(w))
+            right = int(amps[1] * full * math.cos(w))
+            src.push(10 + int(n * period), left=left & ((1 << m.iwidth) - 1), right=right & ((1 << m.iwidth) - 1))
+            n += 1
+
+        yield from tick(10)
+
+        while not src.done():
+            yield from tick(1)
+
+        ctl.push(0, data=0, first=1, last=1)
+        yield from tick(20)
+
+        measured, err, slips, locked = reply.get_data("data")[0]
+        assert locked and not slips, (locked, slips)
+        # the rate, to within one count per window
+        rate = m.fs_in(measured, fs)
+        assert abs(rate - fs_in) <= (fs / (1 << m.window_bits)), (rate, fs_in)
+
+        # silence until locked
+        d = sink.get_data()[0]
+        assert len(d) >= (outputs - 2), len(d)
+        assert d[0]['left'] == 0 and d[0]['right'] == 0, d[0]
+
+        # the tail should be the sine, at 'freq' at the local rate : the
+        # converter is still settling, so fit the frequency to within 0.2%
+        tail = d[-400:]
+        k = np.arange(len(tail))
+        def fit(y, w):
+            basis = np.array([ np.sin(w * k), np.cos(w * k), np.ones(len(k)) ]).T
+            coef, _, _, _ = np.linalg.lstsq(basis, y, rcond=None)
+            noise = np.sqrt(np.mean((y - (basis @ coef)) ** 2))
+            return noise, math.hypot(coef[0], coef[1])
+        for field, amp in zip([ "left", "right" ], amps):
+            y = [ x[field] for x in tail ]
+            y = np.array([ x - (1 << m.iwidth) if x & full else x for x in y ]) / full
+            ws = [ 2 * math.pi * freq * (1 + df) / fs for df in np.linspace(-0.002, 0.002, 41) ]
+            noise, level = min([ fit(y, w) for w in ws ])
+            snr = 20 * math.log10(amp / (noise * math.sqrt(2)))
+            assert abs(level - amp) < 0.001, (field, level, amp)
+            assert snr > 60, (field, snr)
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/resample.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        layout = [("left", 20), ("right", 20)]
+        for fs_in in [ 44100, 48000 ]:
+            dut = Resample(layout=layout, period=96, window_bits=10, gain_bits=10)
+            sim_resample(dut, fs_in, 3200)
+
+#   FIN
@@ -0,0 +1,102 @@
+#!/bin/env python
+
+import sys
+import random
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from tdm import TdmOutput
+
+#
+#
+
+def sim_tdm(m, chans, frames, div=1):
+    print("test tdm", m.slots, "slots", chans, "chans")
+    sim = Simulator(m)
+
+    src = SourceSim(m.i)
+
+    polls = [ src ]
+
+    info = {
+        'ck' : 0,
+        'sck' : 0,
+    }
+    # (ws, sd) on each rising edge of sck
+    bits = []
+    sent = []
+
+    random.seed(chans)
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+            if (yield m.frame):
+                # send the next frame before the end of the last slot
+                words = [ random.randrange(1 << m.iwidth) for c in range(chans) ]
+                for c, word in enumerate(words):
+                    src.push(0, data=word, first=(c == 0), last=(c == (chans - 1)))
+                sent.append(words)
+            sck = yield m.sck
+            if sck and not info['sck']:
+                bits.append(((yield m.ws), (yield m.sd)))
+            info['sck'] = sck
+            # 'en' once every 'div' clocks
+            info['ck'] = (info['ck'] + 1) % div
+            yield m.en.eq(info['ck'] == 0)
+
+    def proc():
+
+        bits_per_frame = m.slots * m.width
+        yield from tick(2 * div * bits_per_frame * (frames + 1))
+
+        # DSP mode A : ws is high for one bit, the last of each frame
+        starts = [ i + 1 for i, (ws, _) in enumerate(bits) if ws ]
+        assert len(starts) >= frames, starts
+        for a, b in zip(starts, starts[1:]):
+            assert (b - a) == bits_per_frame, (a, b)
+
+        decoded = []
+        for start in starts:
+            frame = [ sd for _, sd in bits[start:start+bits_per_frame] ]
+            if len(frame) < bits_per_frame:
+                break
+            slots = [ frame[s*m.width:(s+1)*m.width] for s in range(m.slots) ]
+            decoded.append([ int("".join([ str(b) for b in slot ]), 2) for slot in slots ])
+
+        # each frame requested is sent next, slot 0 first, MSB first, left
+        # justified, with zero in the slots past 'chans'
+        shift = m.width - m.iwidth
+        expect = [ [ w << shift for w in words ] + ([ 0 ] * (m.slots - chans)) for words in sent ]
+        assert expect[0] in decoded, (expect[0], decoded)
+        first = decoded.index(expect[0])
+        n = len(decoded) - first
+        assert n >= (frames - 2), n
+        assert decoded[first:] == expect[:n], (decoded[first:], expect[:n])
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/tdm.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        for slots, chans, div in [ (8, 8, 1), (8, 6, 2), (16, 10, 1) ]:
+            dut = TdmOutput(slots=slots, width=32, iwidth=20)
+            sim_tdm(dut, chans, 4, div)
+
+#   FIN
@@ -0,0 +1,84 @@
+#!/bin/env python
+
+import sys
+import math
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from ppm import TruePeak
+
+#
+#   A sine at fs/4, 45 degrees from the sample points, is sampled at
+#   +/- 0.707 of its peak. The true peak lies between the samples, so
+#   only the interpolated level reaches it.
+
+def sim_truepeak(m, rate, amp):
+    print("test truepeak, rate", rate)
+    sim = Simulator(m)
+
+    sink = SinkSim(m.o)
+    src = SourceSim(m.i)
+
+    polls = [ sink, src ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    mask = (1 << m.width) - 1
+
+    def proc():
+
+        yield m.rate.eq(rate)
+
+        samples = 64
+        data = [ int(round(amp * math.sin((math.pi * n / 2) + (math.pi / 4)))) for n in range(samples) ]
+        for d in data:
+            src.push(0, left=d & mask, right=-d & mask)
+
+        yield from tick(10)
+
+        while not src.done():
+            yield from tick(1)
+
+        yield from tick(200)
+
+        peaks = sink.get_data("data")[0]
+        assert len(peaks) == samples, len(peaks)
+
+        # once the filter is full : the crest is between every other pair
+        # of samples, so take the peak over each two
+        sample_peak = max([ abs(d) for d in data ])
+        for k in range(2 * m.taps, samples, 2):
+            peak = max(peaks[k:k+2])
+            assert peak > (sample_peak * 1.3), (k, peak, sample_peak)
+            assert abs(peak - amp) < (amp * 0.01), (k, peak, amp)
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/truepeak.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        layout = [("left", 16), ("right", 16)]
+        # at rate 2, x4 oversampled input, only the sample phase is run
+        for rate in [ 0, 1 ]:
+            dut = TruePeak(layout=layout, rates=3)
+            sim_truepeak(dut, rate, 0x4000)
+
+#   FIN
@@ -0,0 +1,112 @@
+#!/bin/env python
+
+import sys
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from underrun import Underrun, AlarmLed
+
+#
+#   Transmitters that take every sample, watched by an Underrun,
+#   with its alarm shown on an LED
+
+class Outputs(Elaboratable):
+
+    def __init__(self, n, period):
+        self.i = [ Stream(layout=[("data", 16)], name=f"i{k}") for k in range(n) ]
+        self.underrun = Underrun(n=n, period=period)
+        self.led = AlarmLed(addr=7)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.underrun = self.underrun
+        m.submodules.led = self.led
+        m.d.comb += self.led.alarm.eq(self.underrun.alarm)
+        for k, s in enumerate(self.i):
+            m.d.comb += s.ready.eq(1)
+            m.d.comb += self.underrun.tap(k, s)
+        return m
+
+#
+#
+
+def sim_underrun(m, period):
+    print("test underrun")
+    sim = Simulator(m)
+
+    srcs = [ SourceSim(s) for s in m.i ]
+    ctl = SourceSim(m.underrun.ci)
+    reply = SinkSim(m.underrun.o)
+    led = SinkSim(m.led.o)
+
+    polls = srcs + [ ctl, reply, led ]
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            for poll in polls:
+                yield from poll.poll()
+
+    def read():
+        ctl.push(0, data=0, first=1, last=1)
+        yield from tick(20)
+        return reply.get_data("data")[-1]
+
+    def proc():
+
+        # output 0 is fed every period, output 1 misses 'starve' frames
+        frames = 40
+        starve = 3
+        for f in range(frames):
+            t = 10 + (f * period)
+            srcs[0].push(t, data=f)
+            if not (20 <= f < (20 + starve)):
+                srcs[1].push(t, data=f)
+
+        yield from tick(10)
+
+        while not srcs[0].done():
+            yield from tick(1)
+            if (yield m.underrun.alarm):
+                # raised once the first missing frame is late
+                assert (yield m.underrun.sticky) == 0b10
+
+        assert (yield m.underrun.alarm)
+        counts = yield from read()
+        assert counts == [ 0, starve ], counts
+
+        # the read clears the alarm, the counts are kept
+        yield from tick(period // 2)
+        assert not (yield m.underrun.alarm)
+        counts = yield from read()
+        assert counts == [ 0, starve ], counts
+
+        # one LED packet as the alarm was raised, one as it cleared
+        fields = [ led.get_data(f) for f in [ "addr", "r", "g", "b" ] ]
+        packets = [ [ p[0] for p in packet ] for packet in zip(*fields) ]
+        assert packets == [ [ 7, 0, 0, 0xff ], [ 7, 0, 0, 0 ] ], packets
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/underrun.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        period = 100
+        dut = Outputs(n=2, period=period)
+        sim_underrun(dut, period)
+
+#   FIN
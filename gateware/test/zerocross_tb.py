@@ -0,0 +1,121 @@
+#!/bin/env python
+
+import sys
+import math
+
+from amaranth import *
+from amaranth.sim import *
+
+sys.path.append(".")
+sys.path.append("streams/streams")
+
+from streams.stream import Stream
+from streams.sim import SinkSim, SourceSim
+
+from crossfade import ZeroCross
+
+#
+#   The Select inputs, watched by a ZeroCross
+
+class Inputs(Elaboratable):
+
+    def __init__(self, chans, width, timeout):
+        self.i = [ Stream(layout=[("data", width)], name=f"i{k}") for k in range(2 * chans) ]
+        self.switch = ZeroCross(chans=chans, width=width, timeout=timeout)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.switch = self.switch
+        for k, s in enumerate(self.i):
+            m.d.comb += s.ready.eq(1)
+            m.d.comb += self.switch.tap(k, s, s.data)
+        return m
+
+#
+#
+
+def sim_zerocross(m, period):
+    print("test zerocross")
+    sim = Simulator(m)
+    zc = m.switch
+
+    # samples per cycle of each channel, None for a dead input
+    cycles = [ 40, 30, None ]
+
+    info = {
+        'ck' : 0,
+        'n' : 0,
+    }
+
+    def tick(n=1):
+        assert n
+        for i in range(n):
+            yield Tick()
+            ck = info['ck']
+            for k, s in enumerate(m.i):
+                c = cycles[k // 2]
+                if (ck == 0) and (c is not None):
+                    v = int(1000 * math.sin((2 * math.pi * info['n'] / c) + 0.3 + k))
+                    yield s.data.eq(v)
+                    yield s.valid.eq(1)
+                else:
+                    yield s.valid.eq(0)
+            # the Join only has frames from a live channel
+            live = cycles[(yield zc.channel)] is not None
+            yield zc.frame.eq(live and (ck == (period // 2)))
+            info['ck'] = (ck + 1) % period
+            if info['ck'] == 0:
+                info['n'] += 1
+
+    def switch(chan, limit):
+        # clocks to switch to 'chan'
+        yield zc.select.eq(chan)
+        for t in range(limit):
+            yield from tick(1)
+            if (yield zc.channel) == chan:
+                assert not (yield zc.pending)
+                return t
+        assert 0, ("no switch", chan)
+
+    def proc():
+
+        yield from tick(10 * period)
+        assert (yield zc.channel) == 0
+
+        # both cross zero : before the timeout
+        t = yield from switch(1, 2 * zc.timeout)
+        assert t < zc.timeout, t
+
+        # a dead input never crosses : on a frame after the timeout
+        t = yield from switch(2, 2 * zc.timeout)
+        assert t >= zc.timeout, t
+
+        # from a dead input there are no frames : after the timeout
+        t = yield from switch(0, 3 * zc.timeout)
+        assert t >= zc.timeout, t
+
+        # a change back, while the switch is held, cancels it
+        yield zc.select.eq(2)
+        yield from tick(period)
+        assert (yield zc.pending)
+        yield zc.select.eq(0)
+        yield from tick(2 * zc.timeout)
+        assert (yield zc.channel) == 0
+        assert not (yield zc.pending)
+
+    sim.add_clock(1 / 50e6)
+    sim.add_process(proc)
+    with sim.write_vcd("gtk/zerocross.vcd", traces=[]):
+        sim.run()
+
+#
+#
+
+if __name__ == "__main__":
+    do_all = True
+    if do_all:
+        period = 20
+        dut = Inputs(chans=3, width=16, timeout=100 * period)
+        sim_zerocross(dut, period)
+
+#   FIN
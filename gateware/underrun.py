@@ -0,0 +1,125 @@
+
+from amaranth import *
+
+from streams import Stream
+
+from readback import Registers
+
+#
+#   Underrun detector for the audio transmitters.
+#
+#   tap() watches the input of a transmitter, which takes one sample per
+#   frame, every 'period' clocks (period >> rate at the higher sample rates).
+#   After the first sample, if no sample is taken for 1.5 periods the
+#   transmitter has sent a frame of stale data : the count for that
+#   transmitter is incremented, and again for every further period without
+#   a sample.
+#
+#   'sticky' has a bit per transmitter, set on an underrun. A packet on 'ci'
+#   requests the counts, one word per transmitter, sent as a packet on 'o'.
+#   The request also clears 'sticky'.
+
+class Underrun(Elaboratable):
+
+    def __init__(self, n, period, rates=1, width=32, name="Underrun"):
+        self.name = name
+        self.n = n
+        self.period = period
+        self.rate = Signal(range(rates))
+
+        self.strobe = [ Signal(name=f"strobe{i}") for i in range(n) ]
+        self.armed = Signal(n)
+        self.timers = [ Signal(range(period * 2), name=f"timer{i}") for i in range(n) ]
+        self.counts = [ Signal(width, name=f"count{i}") for i in range(n) ]
+
+        self.sticky = Signal(n)
+        self.alarm = Signal()
+
+        self.regs = Registers(self.counts, width=width, name=f"{name}.regs")
+        self.ci = self.regs.i
+        self.o = self.regs.o
+
+        self.mods = [
+            self.regs,
+        ]
+
+    def tap(self, idx, s):
+        # watch the input stream 's' of a transmitter
+        return [
+            self.strobe[idx].eq(s.valid & s.ready),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules += self.mods
+
+        period = Signal.like(self.timers[0])
+        late = Signal.like(self.timers[0])
+        m.d.comb += [
+            period.eq(self.period >> self.rate),
+            late.eq(period + (period >> 1)),
+        ]
+
+        for i in range(self.n):
+            timer = self.timers[i]
+            with m.If(self.strobe[i]):
+                m.d.sync += [
+                    timer.eq(0),
+                    self.armed[i].eq(1),
+                ]
+            with m.Elif(self.armed[i]):
+                with m.If(timer == late):
+                    # a stale frame, check again in another period
+                    m.d.sync += [
+                        timer.eq(late - period),
+                        self.counts[i].eq(self.counts[i] + 1),
+                        self.sticky[i].eq(1),
+                    ]
+                with m.Else():
+                    m.d.sync += timer.eq(timer + 1)
+
+        with m.If(self.ci.valid & self.ci.ready & self.ci.last):
+            m.d.sync += self.sticky.eq(0)
+
+        m.d.comb += self.alarm.eq(self.sticky.any())
+
+        return m
+
+#
+#   Show an alarm on one LED of a LedStream.
+#
+#   A packet (addr, r, g, b) is sent on 'o' each time 'alarm' changes,
+#   'colour' when set, else off.
+
+class AlarmLed(Elaboratable):
+
+    def __init__(self, addr, colour=(0, 0, 0xff), name="AlarmLed"):
+        self.name = name
+        self.addr = addr
+        self.colour = colour
+        self.alarm = Signal()
+        self.o = Stream(layout=[("addr", 8), ("r", 8), ("g", 8), ("b", 8)], name="o")
+
+        # the state last sent
+        self.shown = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        with m.If(self.o.valid & self.o.ready):
+            m.d.sync += self.o.valid.eq(0)
+
+        with m.If((self.alarm != self.shown) & ~self.o.valid):
+            m.d.sync += [
+                self.shown.eq(self.alarm),
+                self.o.valid.eq(1),
+                self.o.first.eq(1),
+                self.o.last.eq(1),
+                self.o.addr.eq(self.addr),
+            ]
+            for field, level in zip([ "r", "g", "b" ], self.colour):
+                m.d.sync += getattr(self.o, field).eq(Mux(self.alarm, level, 0))
+
+        return m
+
+#   FIN
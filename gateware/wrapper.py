@@ -1,7 +1,7 @@
 
 import amaranth
 from amaranth.hdl import _ast, _ir
-from amaranth.back import verilog
+from amaranth.back import verilog, rtlil
 
 # https://github.com/orbcode/orbtrace/blob/main/orbtrace/amaranth_glue/wrapper.py
 
@@ -9,23 +9,34 @@ import migen
 
 from litex.soc.interconnect.stream import Endpoint, EndpointDescription
 
+import hashlib
 from pathlib import Path
 
 class Wrapper(migen.Module):
-    def __init__(self, platform, name = 'amaranth_wrapper'):
+    # Verilog files kept in the cache for each wrapper, most recently used
+    cache_keep = 8
+
+    def __init__(self, platform, name = 'amaranth_wrapper', verbose = False):
         self.platform = platform
         self.name = name
+        self.verbose = verbose
 
         self.m = amaranth.Module()
 
         self.connections = []
+        # bridged signals, both ways : id(amaranth) -> migen, id(migen) -> amaranth
         self._map = {}
+        self._rmap = {}
+
+    def log(self, *args):
+        if self.verbose:
+            print(*args)
 
     def add_module(self, m):
         self.m.submodules += m
 
     def connect(self, migen_sig, amaranth_sig):
-        print("connect", migen_sig, amaranth_sig, f"id={id(amaranth_sig)}")
+        self.log("connect", migen_sig, amaranth_sig, f"id={id(amaranth_sig)}")
         self.connections.append((migen_sig, amaranth_sig))
 
     def connect_domain(self, name):
@@ -37,13 +48,14 @@ class Wrapper(migen.Module):
         self.connect(migen.ResetSignal(name), amaranth.ResetSignal(n))
 
     def from_amaranth(self, amaranth_sig):
-        assert isintance(amaranth_sig, amaranth.Signal)
+        assert isinstance(amaranth_sig, amaranth.Signal)
         tag = id(amaranth_sig)
         if tag in self._map:
             return self._map[tag]
         shape = amaranth_sig.shape()
         migen_sig = migen.Signal((shape.width, shape.signed), name = amaranth_sig.name)
         self._map[tag] = migen_sig
+        self._rmap[id(migen_sig)] = amaranth_sig
 
         self.connect(migen_sig, amaranth_sig)
 
@@ -51,7 +63,12 @@ class Wrapper(migen.Module):
 
     def from_migen(self, migen_sig):
         assert isinstance(migen_sig, migen.Signal)
+        tag = id(migen_sig)
+        if tag in self._rmap:
+            return self._rmap[tag]
         amaranth_sig = amaranth.Signal(amaranth.Shape(migen_sig.nbits, migen_sig.signed))
+        self._rmap[tag] = amaranth_sig
+        self._map[id(amaranth_sig)] = migen_sig
 
         self.connect(migen_sig, amaranth_sig)
 
@@ -61,11 +78,8 @@ class Wrapper(migen.Module):
         connections = {}
 
         for m, n in self.connections:
-            print("zzz", m, n, f"id={id(n)}")
-            for x in self.amaranth_name_map.items():
-                print("xxx", x)
-            name, direction = self.amaranth_name_map[n]
-            s = f'{direction}_{name}'
+            self.log("instance", m, n, f"id={id(n)}")
+            s = self.port_index[n]
 
             assert s not in connections, f'Signal {s} connected multiple times.'
 
@@ -73,13 +87,28 @@ class Wrapper(migen.Module):
 
         return migen.Instance(self.name, **connections)
 
-    def generate_verilog(self):
+    def netlist_to_rtlil(self, netlist):
+        # As back.rtlil.convert_fragment(), but from an existing netlist
+        name_map = _ast.SignalDict()
+        empty_checker = rtlil.EmptyModuleChecker(netlist)
+        builder = rtlil.Design(emit_src=True)
+        for module_idx, module in enumerate(netlist.modules):
+            if empty_checker.is_empty(module_idx):
+                continue
+            module_builder = builder.module(".".join(module.name), src_loc=module.src_loc)
+            if module_idx == 0:
+                module_builder.attribute("top", 1)
+            rtlil.ModuleEmitter(module_builder, netlist, module, name_map,
+                          empty_checker=empty_checker).emit()
+        return str(builder)
+
+    def generate_verilog(self, cache_dir=None):
 
         ports = [n for m, n in self.connections]
 
         fragment = _ir.Fragment.get(self.m, None).prepare(ports = ports, hierarchy = (self.name,))
 
-        v, _name_map = verilog.convert_fragment(fragment, name = self.name)
+        # Build the netlist once and use it for both the name map and the Verilog
         netlist = _ir.build_netlist(fragment, name = self.name)
 
         self.amaranth_name_map = _ast.SignalDict((sig, (name, 'o' if name in netlist.top.ports_o else 'i')) for name, sig, _ in fragment.ports)
@@ -90,13 +119,44 @@ class Wrapper(migen.Module):
             if domain.rst in self.amaranth_name_map:
                 self.amaranth_name_map[amaranth.ResetSignal(name)] = self.amaranth_name_map[domain.rst]
 
+        # Instance port name for each signal, eg. 'i_clk'
+        self.port_index = _ast.SignalDict((sig, f'{direction}_{name}') for sig, (name, direction) in self.amaranth_name_map.items())
+
+        # The yosys RTLIL -> Verilog step dominates, so cache its output,
+        # keyed by a hash of the RTLIL (which includes the port list).
+        rtlil_text = self.netlist_to_rtlil(netlist)
+
+        path = None
+        if cache_dir is not None:
+            key = hashlib.sha256(rtlil_text.encode()).hexdigest()
+            path = Path(cache_dir) / f'{self.name}_{key}.v'
+            if path.exists():
+                # mark as recently used
+                path.touch()
+                return path.read_text()
+
+        v = verilog._convert_rtlil_text(rtlil_text)
+
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(v)
+            self.prune_cache(cache_dir)
+
         return v
 
+    def prune_cache(self, cache_dir, keep=None):
+        # delete all but the 'keep' most recently used files for this wrapper
+        keep = self.cache_keep if keep is None else keep
+        paths = sorted(Path(cache_dir).glob(f'{self.name}_*.v'), key=lambda p: p.stat().st_mtime, reverse=True)
+        for path in paths[keep:]:
+            path.unlink(missing_ok=True)
+
     def do_finalize(self):
         verilog_filename = str(Path(self.platform.output_dir) / 'gateware' / f'{self.name}.v')
+        cache_dir = Path(self.platform.output_dir) / 'amaranth_cache'
 
         with open(verilog_filename, 'w') as f:
-            f.write(self.generate_verilog())
+            f.write(self.generate_verilog(cache_dir=cache_dir))
 
         self.platform.add_source(verilog_filename)
 
@@ -110,7 +170,7 @@ class Wrapper(migen.Module):
         def me(a): return a
 
         for (name,), flow, asig in ainterface.signature.flatten(ainterface):
-            print(name, flow, asig)
+            self.log(name, flow, asig)
             msig = self.from_amaranth(asig)
             fn = mapping.get(name, me)
             signals[name] = fn(msig)
@@ -129,7 +189,7 @@ class Wrapper(migen.Module):
 
         for name, _, _ in layout:
             s = signals[name]
-            print(name, s)
+            self.log(name, s)
             setattr(record, name, s)
 
         return record